@@ -3,18 +3,21 @@ import os
 import json
 import time
 import uuid
+import base64
 import hashlib
 from pathlib import Path
 import pandas as pd
 import streamlit as st
+import streamlit.components.v1 as components
 
-from services.voice import tts_gtts, transcribe_audio_bytes
-from services.db import init_db, insert_message, upsert_user, log_event  # keep db.py as you sent
+from services.voice import synthesize_segments, tts_format, join_audio, transcribe_audio_bytes
+from services.db import (init_db, insert_message, upsert_user, log_event, get_user_by_email,
+                         create_account, migrate_accounts_json)
 from services.router import deep_link_for_intent
-from services.llm import chat_complete
-from services.rag import VectorStore, pdf_to_chunks, rag_answer
+from services.llm import chat_complete_stream
+from services.rag import VectorStore, StaleIndexError, INDEX_DIR, hash_bytes, index_pdf, rag_answer_stream
 from services.intent import detect_lang, rule_intent
-from services.recommender import load_jobs_csv, make_recs
+from services.recommender import get_job_index
 from services.utils import init_session
 
 # ---------- App Config ----------
@@ -24,25 +27,35 @@ st.set_page_config(page_title="PGRKAM AI Assistant", page_icon="🌐", layout="w
 init_db()
 init_session()
 
+@st.cache_resource(show_spinner=False)
+def shared_index() -> VectorStore:
+    """
+    The one VectorStore of this process, shared by all sessions: the saved
+    index memory-mapped, or an empty store (never None, so a missing index is
+    not cached) that the sidebar fills and saves for everyone.
+    """
+    try:
+        return VectorStore.load(INDEX_DIR, mmap=True)
+    except (FileNotFoundError, StaleIndexError):
+        return VectorStore()
+
+st.session_state.vector_store = shared_index()
+
 # ---------- Secrets / env ----------
 if "GROQ_API_KEY" not in os.environ and "GROQ_API_KEY" in st.secrets:
     os.environ["GROQ_API_KEY"] = st.secrets["GROQ_API_KEY"]
 if "MODEL_NAME" in st.secrets:
     os.environ["MODEL_NAME"] = st.secrets["MODEL_NAME"]
 
-# ---------- Simple account store (JSON file) ----------
-ACCOUNTS_PATH = Path("users.json")
+# ---------- Account store (users table in services/db) ----------
+ACCOUNTS_PATH = Path("users.json")  # legacy JSON store, imported once below
 
-def _load_accounts() -> dict:
-    if ACCOUNTS_PATH.exists():
-        try:
-            return json.loads(ACCOUNTS_PATH.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_accounts():
+    """users.json → users table, once per process (no-op after the file is renamed)."""
+    return migrate_accounts_json(str(ACCOUNTS_PATH))
 
-def _save_accounts(data: dict):
-    ACCOUNTS_PATH.write_text(json.dumps(data, indent=2), encoding="utf-8")
+migrate_legacy_accounts()
 
 def _hash_password(pw: str) -> str:
     return hashlib.sha256(pw.encode("utf-8")).hexdigest()
@@ -112,18 +125,15 @@ def render_auth():
             if not email or not password:
                 st.error("Please enter both email and password.")
             else:
-                accounts = _load_accounts()
-                entry = accounts.get(email)
+                entry = get_user_by_email(email)
                 if not entry:
                     st.error("No account found. Please sign up first.")
                 else:
                     if entry["pass_hash"] != _hash_password(password):
                         st.error("Incorrect password.")
                     else:
-                        user_id = entry["user_id"]
+                        user_id = entry["user_key"]
                         name = entry.get("name") or email.split("@")[0]
-                        # Ensure a row exists in DB users (db.py has minimal schema)
-                        upsert_user(user_key=user_id)
                         set_logged_in(user_id, email, name)
                         st.success("Logged in successfully.")
                         st.rerun()
@@ -141,25 +151,83 @@ def render_auth():
             elif password != confirm:
                 st.error("Passwords do not match.")
             else:
-                accounts = _load_accounts()
-                if email in accounts:
+                user_id = _user_id_from_email(email)
+                if get_user_by_email(email) or not create_account(user_id, email, name, _hash_password(password)):
                     st.error("This email is already registered. Please log in.")
                 else:
-                    user_id = _user_id_from_email(email)
-                    accounts[email] = {
-                        "user_id": user_id,
-                        "name": name,
-                        "pass_hash": _hash_password(password),
-                        "created_at": int(time.time()),
-                    }
-                    _save_accounts(accounts)
-                    # Minimal users row in SQLite (compatible with your db.py)
-                    upsert_user(user_key=user_id)
                     log_event(user_id, "auth_signup", 1.0, json.dumps({"email": email}))
                     set_logged_in(user_id, email, name)
                     st.success("Account created and logged in.")
                     st.rerun()
 
+# ---------- Voice reply ----------
+# Playback queue installed once in the app page (not in a component iframe, so
+# it outlives the iframes and reruns): clips of one reply play back to back,
+# each as soon as it has arrived and the previous one has ended; a new reply
+# stops the old one.
+_TTS_PLAYER_JS = """
+window.__ttsQueue = {
+  job: null, next: 0, clips: {}, audio: null,
+  push(job, idx, src) {
+    if (job !== this.job) {
+      if (this.audio) this.audio.pause();
+      Object.assign(this, {job: job, next: 0, clips: {}, audio: null});
+    }
+    this.clips[idx] = src;
+    this.pump();
+  },
+  pump() {
+    if (this.audio || !(this.next in this.clips)) return;
+    const a = this.audio = new Audio(this.clips[this.next]);
+    delete this.clips[this.next];
+    const done = () => { if (this.audio === a) { this.audio = null; this.next += 1; this.pump(); } };
+    a.onended = done;
+    a.onerror = done;
+    a.play().catch(done);
+  },
+};
+"""
+
+def _queue_segment(job: str, idx: int, seg: bytes, fmt: str):
+    """Zero-height component handing one clip to the page's playback queue."""
+    src = f"data:{fmt};base64,{base64.b64encode(seg).decode('ascii')}"
+    components.html(f"""<script>
+const w = window.parent;
+if (!w.__ttsQueue) {{
+  const s = w.document.createElement("script");
+  s.textContent = {json.dumps(_TTS_PLAYER_JS)};
+  w.document.head.appendChild(s);
+}}
+w.__ttsQueue.push({json.dumps(job)}, {idx}, {json.dumps(src)});
+</script>""", height=0)
+
+def speak_pending_reply(slot):
+    """
+    Speak the reply queued by the chat tab sentence by sentence: segments are
+    synthesized concurrently and each is sent to the browser as soon as it is
+    ready, where _TTS_PLAYER_JS plays them in order. Nothing waits for
+    playback here, so the run ends once synthesis is done. The joined clip is
+    kept in voice_queue for replay after later reruns.
+    """
+    job = st.session_state.pop("pending_tts", None)
+    if not job:
+        return
+    fmt = tts_format()
+    job_id = uuid.uuid4().hex
+    segments = []
+    try:
+        with slot.container():
+            for idx, seg in enumerate(synthesize_segments(job["text"], lang_hint=job["lang"])):
+                segments.append(seg)
+                _queue_segment(job_id, idx, seg, fmt)
+    except Exception as e:
+        slot.warning(f"Voice reply issue: {e}")
+    finally:
+        # joined once, also when a rerun interrupts synthesis
+        if segments:
+            st.session_state.voice_queue.append(
+                {"bytes": join_audio(segments, fmt), "format": fmt, "ts": int(time.time())})
+
 # ---------- Main App (after login) ----------
 def render_app():
     st.title("🌐 PGRKAM AI Assistant")
@@ -168,7 +236,7 @@ def render_app():
 
     # Initialize voice queue to keep audio after reruns
     if "voice_queue" not in st.session_state:
-        st.session_state.voice_queue = []  # list of dicts: {"bytes": mp3bytes, "ts": int}
+        st.session_state.voice_queue = []  # list of dicts: {"bytes": audio, "format": mime, "ts": int}
 
     # Logout & History controls
     left_sb, right_sb = st.sidebar.columns([0.55, 0.55])
@@ -183,6 +251,22 @@ def render_app():
     # ---- Sidebar: Knowledge base upload (optional) ----
     st.sidebar.header("📚 Knowledge Base")
     uploaded = st.sidebar.file_uploader("Upload PDFs (FAQs, schemes, notices)", type=["pdf"], accept_multiple_files=True)
+    if uploaded and st.sidebar.button("⚙️ Build/Update Index", use_container_width=True):
+        vs = shared_index()  # updated in place; VectorStore locks its own mutations
+        added = 0
+        try:
+            with st.sidebar.status("Indexing PDFs…"):
+                for f in uploaded:
+                    digest = hash_bytes(f.getvalue())
+                    if vs.sources.get(f.name) == digest:
+                        continue  # unchanged since last build → no re-embedding
+                    added += index_pdf(vs, f, source_hash=digest)
+            if vs.index is not None:
+                vs.save(INDEX_DIR)
+            log_event(st.session_state.user_key, "index_update", float(added), json.dumps({"files": [f.name for f in uploaded]}))
+            st.sidebar.success(f"Index updated: {added} new chunks.")
+        except Exception as e:
+            st.sidebar.error(f"Indexing failed: {e}")
 
     # ---- Sidebar: Preferences (persist only if not empty) ----
     st.sidebar.header("🎯 Preferences")
@@ -294,34 +378,37 @@ def render_app():
                 query = st.session_state.chat_input.strip()
                 lang = safe_detect_lang(query)
                 intent = rule_intent(query)
-                vs = st.session_state.get("vector_store") if ask_rag else None
+                vs = st.session_state.vector_store if ask_rag else None
+                if vs is not None and vs.index is None:
+                    vs = None  # nothing indexed yet → plain chat
 
+                # stream the reply so the first tokens render while the rest generates
+                st.chat_message("user").write(query)
+                rag_stats = {}
                 if vs is not None:
-                    answer = rag_answer(vs, query, lang, chat_complete)
+                    stream = rag_answer_stream(vs, query, lang, chat_complete_stream, stats=rag_stats)
                 else:
-                    answer = chat_complete(
+                    stream = chat_complete_stream(
                         "You are a helpful assistant for the PGRKAM portal.",
                         f"User language: {lang}\nUser query: {query}\nAnswer briefly with steps if relevant."
                     )
+                with st.chat_message("assistant"):
+                    answer = st.write_stream(stream)
 
                 # persist messages
-                insert_message(st.session_state.user_key, "user", query, intent=intent)
-                insert_message(st.session_state.user_key, "assistant", answer, intent=intent)
+                meta = json.dumps({"lang": lang})
+                insert_message(st.session_state.user_key, "user", query, intent=intent, meta_json=meta)
+                insert_message(st.session_state.user_key, "assistant", answer, intent=intent, meta_json=meta)
 
                 if "history" not in st.session_state:
                     st.session_state.history = []
                 st.session_state.history.append(("user", query))
                 st.session_state.history.append(("assistant", answer))
 
-                log_event(st.session_state.user_key, "ask", 1.0, json.dumps({"intent": intent, "rag": ask_rag}))
+                log_event(st.session_state.user_key, "ask", 1.0, json.dumps({"intent": intent, "rag": ask_rag, "lang": lang, **rag_stats}))
 
-                # ---- ALWAYS SPEAK REPLY (store bytes so they persist after rerun) ----
-                try:
-                    tts_bytes = tts_gtts(answer, lang_hint=lang)
-                    if tts_bytes:
-                        st.session_state.voice_queue.append({"bytes": tts_bytes, "ts": int(time.time())})
-                except Exception as e:
-                    st.warning(f"Voice reply issue: {e}")
+                # ---- ALWAYS SPEAK REPLY: synthesized per sentence by speak_pending_reply after the rerun ----
+                st.session_state.pending_tts = {"text": answer, "lang": lang}
 
                 # Signal to clear input on next run (avoids StreamlitAPIException)
                 st.session_state._clear_chat = True
@@ -335,10 +422,11 @@ def render_app():
                     else:
                         st.chat_message("assistant").write(msg)
 
-            # Render latest voice reply player (persisted)
-            if st.session_state.voice_queue:
+            # Render latest voice reply player (persisted); a pending reply plays here at the end of the run
+            voice_slot = st.empty()
+            if st.session_state.voice_queue and not st.session_state.get("pending_tts"):
                 last = st.session_state.voice_queue[-1]
-                st.audio(last["bytes"], format="audio/mp3")
+                voice_slot.audio(last["bytes"], format=last.get("format", "audio/mp3"))
 
         # Right: routing + recs
         with col2:
@@ -354,8 +442,7 @@ def render_app():
             st.subheader("🔎 Job Recommendations")
             jobs_path = "data/pgrkam_jobs.csv"  # keep if you have one; else handle exception
             try:
-                df = load_jobs_csv(jobs_path)
-                recs = make_recs(df, st.session_state.prefs, top_k=5)
+                recs = get_job_index(jobs_path).recommend(st.session_state.prefs, top_k=5)
                 for _, row in recs.iterrows():
                     with st.container(border=True):
                         st.write(f"**{row['title']}** — {row['location']} · {row['sector']}")
@@ -383,23 +470,13 @@ def render_app():
         # Basic analytics from DB
         try:
             import plotly.express as px
-            from sqlalchemy import text as sqltext
-            from services.db import engine
-
-            with engine.begin() as con:
-                intents = list(con.execute(sqltext("""
-                    SELECT intent, COUNT(*) cnt
-                    FROM messages
-                    WHERE intent IS NOT NULL AND intent!=''
-                    GROUP BY intent
-                    ORDER BY cnt DESC
-                """)))
-                hourly = list(con.execute(sqltext("""
-                    SELECT strftime('%Y-%m-%d %H:00', ts, 'unixepoch') h, COUNT(*) c
-                    FROM messages
-                    GROUP BY h
-                    ORDER BY h
-                """)))
+            from services.db import (flush_writes, refresh_rollups, rollup_intents, rollup_hourly_counts,
+                                     rollup_langs, rollup_daily_active_users, rollup_rag_ratio)
+
+            flush_writes(timeout=2)  # include this session's queued messages
+            refresh_rollups()  # folds in only rows newer than the last refresh
+            intents = rollup_intents()
+            hourly = rollup_hourly_counts()
 
             c1, c2 = st.columns(2)
             with c1:
@@ -414,9 +491,29 @@ def render_app():
                     st.plotly_chart(px.line(df_h, x="hour", y="count"), use_container_width=True)
                 else:
                     st.info("No messages yet to chart over time.")
+
+            c3, c4, c5 = st.columns(3)
+            with c3:
+                dau = rollup_daily_active_users()
+                if dau:
+                    df_dau = pd.DataFrame(dau, columns=["day","users"])
+                    st.plotly_chart(px.bar(df_dau, x="day", y="users", title="Daily active users"), use_container_width=True)
+            with c4:
+                langs = rollup_langs()
+                if langs:
+                    df_lang = pd.DataFrame(langs, columns=["lang","count"])
+                    st.plotly_chart(px.pie(df_lang, names="lang", values="count", title="Languages"), use_container_width=True)
+            with c5:
+                rag = rollup_rag_ratio()
+                if rag:
+                    df_rag = pd.DataFrame(rag, columns=["day","rag","non_rag"])
+                    st.plotly_chart(px.bar(df_rag, x="day", y=["rag","non_rag"], title="RAG vs non-RAG asks"), use_container_width=True)
         except Exception as e:
             st.warning(f"Analytics unavailable: {e}")
 
+    # last, so synthesis never delays the rest of the page
+    speak_pending_reply(voice_slot)
+
 # ---------- Entry Point ----------
 if "auth_user" not in st.session_state:
     ensure_session_user()
@@ -0,0 +1,98 @@
+# services/answer_cache.py
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from typing import Dict, Iterable, Optional, Tuple
+
+# semantic answer cache in front of the LLM (set ANSWER_CACHE_SIZE=0 to disable)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600)))  # seconds
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.92"))  # query cosine
+_cache = None
+_cache_lock = threading.Lock()
+
+class AnswerCache:
+    """
+    Answers keyed by (index generation, language, retrieved chunk ids) plus the
+    query embedding. A lookup only considers entries whose retrieval produced
+    exactly the same chunks from the same index build, then returns the
+    closest stored query if its cosine similarity reaches `threshold`.
+    Entries expire after `ttl` seconds; beyond `capacity` the least recently
+    used entry is evicted.
+    """
+    def __init__(self, capacity: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 threshold: float = ANSWER_CACHE_THRESHOLD):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries: "OrderedDict[int, Tuple[tuple, np.ndarray, str, float]]" = OrderedDict()
+        self._buckets: Dict[tuple, list] = {}  # bucket key -> entry ids
+        self._next = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def bucket_key(generation: str, lang: str, chunk_ids: Iterable[int]) -> tuple:
+        return (generation, lang or "", tuple(sorted(int(c) for c in chunk_ids)))
+
+    def _drop(self, eid: int):
+        bucket, _, _, _ = self.entries.pop(eid)
+        members = self._buckets.get(bucket)
+        if members:
+            members.remove(eid)
+            if not members:
+                del self._buckets[bucket]
+
+    def get(self, query_vec: np.ndarray, generation: str, lang: str, chunk_ids: Iterable[int]) -> Optional[str]:
+        bucket = self.bucket_key(generation, lang, chunk_ids)
+        now = time.time()
+        with self.lock:
+            best, best_sim = None, self.threshold
+            for eid in list(self._buckets.get(bucket, ())):
+                _, vec, answer, ts = self.entries[eid]
+                if now - ts > self.ttl:
+                    self._drop(eid)
+                    continue
+                sim = float(np.dot(vec, query_vec))  # embeddings are L2-normalized
+                if sim >= best_sim:
+                    best, best_sim = eid, sim
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            self.hits += 1
+            return self.entries[best][2]
+
+    def put(self, query_vec: np.ndarray, generation: str, lang: str, chunk_ids: Iterable[int], answer: str):
+        bucket = self.bucket_key(generation, lang, chunk_ids)
+        with self.lock:
+            eid = self._next
+            self._next += 1
+            self.entries[eid] = (bucket, np.array(query_vec, dtype="float32"), answer, time.time())
+            self._buckets.setdefault(bucket, []).append(eid)
+            while len(self.entries) > self.capacity:
+                self._drop(next(iter(self.entries)))  # evict LRU
+
+    def invalidate(self, generation: Optional[str] = None):
+        """Drop entries of one index generation (all entries if None)."""
+        with self.lock:
+            for eid in [e for e, (b, _, _, _) in self.entries.items() if generation is None or b[0] == generation]:
+                self._drop(eid)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "capacity": self.capacity}
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    global _cache
+    if ANSWER_CACHE_SIZE <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache()
+    return _cache
@@ -0,0 +1,74 @@
+# services/bm25.py
+import re
+import math
+import heapq
+from collections import Counter
+from typing import Dict, List, Tuple, Iterable
+
+# word chars plus Devanagari/Gurmukhi blocks (vowel signs are not \w)
+_TOKEN = re.compile(r"[\w\u0900-\u097F\u0A00-\u0A7F]+")
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall((text or "").lower())
+
+class BM25Index:
+    """
+    Inverted-index Okapi BM25 over id-keyed documents. Catches exact tokens
+    (scheme names, post codes, districts, dates) that dense embeddings blur.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}  # term -> {doc_id: tf}
+        self.doc_len: Dict[int, int] = {}
+        self._doc_terms: Dict[int, List[str]] = {}
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, doc_id: int, text: str):
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        tf = Counter(tokenize(text))
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[doc_id] = n
+        length = sum(tf.values())
+        self.doc_len[doc_id] = length
+        self._doc_terms[doc_id] = list(tf)
+        self._total_len += length
+
+    def remove(self, doc_id: int):
+        for term in self._doc_terms.pop(doc_id, []):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[term]
+        self._total_len -= self.doc_len.pop(doc_id, 0)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        n_docs = len(self.doc_len)
+        if not n_docs:
+            return []
+        avgdl = self._total_len / n_docs or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc_id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+def reciprocal_rank_fusion(rankings: Iterable[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse ranked id lists: score(d) = sum 1 / (k + rank). Best first."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
@@ -1,13 +1,19 @@
 # services/crawl.py
-import re, time, requests
-from urllib.parse import urljoin, urlparse
+import os, re, json, time, asyncio, hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib import robotparser
+from urllib.parse import urljoin, urlparse, urlunparse, urldefrag
 from bs4 import BeautifulSoup
+from services.http_client import make_async_client, arequest
 
 HEADERS = {"User-Agent": "Mozilla/5.0 (edu project)"}
+STRIP_TAGS = ("script","style","noscript","header","footer","nav","iframe")
 
 def clean_text(html: str) -> str:
     soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["script","style","noscript","header","footer","nav","iframe"]):
+    for tag in soup(list(STRIP_TAGS)):
         tag.decompose()
     text = soup.get_text(separator="\n")
     text = re.sub(r"\n{2,}", "\n", text)
@@ -16,34 +22,295 @@ def clean_text(html: str) -> str:
 def same_domain(url, allowed_domain):
     return urlparse(url).netloc.endswith(allowed_domain)
 
-def crawl_urls(seeds, allowed_domain="pgrkam.com", max_pages=30, timeout=15):
-    seen, pages = set(), []
-    queue = [s.strip() for s in seeds if s.strip()]
-    while queue and len(pages) < max_pages:
-        url = queue.pop(0)
-        if url in seen: continue
-        seen.add(url)
+def normalize_url(url: str) -> str:
+    """Drop fragments and default ports, lowercase scheme/host, '' path -> '/'."""
+    url, _ = urldefrag(url.strip())
+    p = urlparse(url)
+    scheme, netloc = p.scheme.lower(), p.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunparse((scheme, netloc, p.path or "/", p.params, p.query, ""))
+
+def parse_page(url: str, html: str, strip_tags=STRIP_TAGS, flat: bool = False) -> dict:
+    """
+    CPU-bound half of the crawl (runs in the worker pool).
+    flat=False keeps line breaks like clean_text; flat=True collapses all
+    whitespace like ingest._clean_text.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    title = re.sub(r"\s+", " ", soup.title.get_text()).strip() if soup.title else ""
+    links = []
+    for a in soup.find_all("a", href=True):
+        href = urljoin(url, a["href"])
+        if href.startswith("mailto:") or href.startswith("tel:") or href.startswith("javascript:"):
+            continue
+        links.append(normalize_url(href))
+    for tag in soup(list(strip_tags)):
+        tag.decompose()
+    if flat:
+        text = re.sub(r"\s+", " ", soup.get_text(" ")).strip()
+    else:
+        text = re.sub(r"\n{2,}", "\n", soup.get_text(separator="\n")).strip()
+    return {"title": title, "text": text, "links": links}
+
+# ---------- recrawl state ----------
+class CrawlState:
+    """
+    Per-URL validators (ETag / Last-Modified), hash of the cleaned text and
+    outgoing links from the last crawl, persisted as JSON. Lets a recrawl send
+    conditional GETs, keep walking through 304 pages, and report a change feed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception:
+                self.entries = {}
+        self._known = set(self.entries)
+        self.added, self.changed, self.unchanged, self.gone, self.failed = [], [], [], [], []
+        self.complete = False  # set by crawl_async when the frontier was exhausted
+
+    def conditional_headers(self, url: str) -> dict:
+        e = self.entries.get(url) or {}
+        h = {}
+        if e.get("etag"):
+            h["If-None-Match"] = e["etag"]
+        if e.get("last_modified"):
+            h["If-Modified-Since"] = e["last_modified"]
+        return h
+
+    def links(self, url: str):
+        return (self.entries.get(url) or {}).get("links", [])
+
+    def record(self, url: str, text: str, links, etag: str = None, last_modified: str = None) -> str:
+        """Store a 200 response; returns "added", "changed" or "unchanged"."""
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        prev = self.entries.get(url)
+        if prev is None:
+            status = "added"
+        elif prev.get("hash") != digest:
+            status = "changed"
+        else:
+            status = "unchanged"
+        self.entries[url] = {"etag": etag, "last_modified": last_modified, "hash": digest,
+                             "links": list(links), "ts": int(time.time())}
+        getattr(self, status).append(url)
+        return status
+
+    def not_modified(self, url: str):
+        self.entries[url]["ts"] = int(time.time())
+        self.unchanged.append(url)
+
+    def mark_gone(self, url: str):
+        if self.entries.pop(url, None) is not None:
+            self.gone.append(url)
+
+    def mark_failed(self, url: str):
+        """Timeout, 5xx after retries, non-HTML answer or robots block: keep the old entry."""
+        if url in self.entries:
+            self.failed.append(url)
+
+    def hash_of(self, url: str):
+        return (self.entries.get(url) or {}).get("hash")
+
+    def changes(self) -> dict:
+        """
+        Change feed of this run. "removed" holds URLs answering 404/410 and,
+        if the crawl reached every page, known URLs that are no longer linked.
+        Known URLs that could not be fetched are listed under "failed" and
+        are never removed (their old links were still followed).
+        """
+        removed = list(self.gone)
+        if self.complete:
+            reached = set(self.added) | set(self.changed) | set(self.unchanged) | set(self.failed)
+            removed += sorted(u for u in self._known if u not in reached and u in self.entries)
+        return {"added": list(self.added), "changed": list(self.changed),
+                "removed": removed, "unchanged": len(self.unchanged), "failed": list(self.failed)}
+
+    def save(self):
+        for url in self.changes()["removed"]:
+            self.entries.pop(url, None)
+        tmp = self.path + ".tmp"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+# ---------- async crawler ----------
+async def _robots_for(client, host_url: str, cache: dict):
+    origin = "{0.scheme}://{0.netloc}".format(urlparse(host_url))
+    if origin not in cache:
+        rp = robotparser.RobotFileParser()
         try:
-            r = requests.get(url, headers=HEADERS, timeout=timeout)
-            if r.status_code != 200 or "text/html" not in r.headers.get("Content-Type",""):
-                continue
-            text = clean_text(r.text)
-            if len(text) < 200:  # skip tiny pages
-                continue
-            pages.append({"url": url, "text": text})
-            # discover new links
-            soup = BeautifulSoup(r.text, "html.parser")
-            for a in soup.select("a[href]"):
-                nxt = urljoin(url, a["href"])
-                if nxt.startswith("mailto:") or nxt.startswith("tel:"): 
-                    continue
-                if same_domain(nxt, allowed_domain) and nxt not in seen and len(queue) < 200:
-                    queue.append(nxt)
-            time.sleep(0.2)
+            r = await arequest(client, "GET", origin + "/robots.txt", retries=1,
+                               endpoint=f"GET {urlparse(origin).netloc}/robots.txt")
+            rp.parse(r.text.splitlines() if r.status_code == 200 else [])
         except Exception:
-            continue
+            rp.parse([])  # unreachable robots.txt → allow
+        cache[origin] = rp
+    return cache[origin]
+
+async def crawl_async(
+    seeds,
+    allowed_domain: str = "pgrkam.com",
+    max_pages: int = 30,
+    allow_paths=None,
+    min_chars: int = 0,
+    concurrency: int = 8,
+    per_host: int = 2,
+    delay: float = 0.2,
+    timeout: float = 15,
+    headers=None,
+    strip_tags=STRIP_TAGS,
+    flat: bool = False,
+    respect_robots: bool = True,
+    parse_workers: int = None,
+    max_frontier: int = 1000,
+    out_path: str = None,
+    state: CrawlState = None,
+):
+    """
+    Concurrent BFS crawl. `concurrency` pooled keep-alive connections overall
+    (HTTP/2 and 429/5xx backoff via services.http_client),
+    at most `per_host` in flight per host and request starts to one host spaced
+    by `delay` seconds. HTML parsing runs in a process pool (`parse_workers`,
+    0 = default thread pool). Pages are {"url","title","text","ts"} records,
+    the save_jsonl format; with `out_path` they are appended as they arrive.
+    With `state`, known URLs are fetched conditionally: 304 pages count
+    towards max_pages but are not returned, and their stored links are followed.
+    Known URLs that fail (timeout, 5xx, non-HTML, robots) are recorded with
+    state.mark_failed and their stored links are followed too, so neither
+    they nor the pages only they link to are reported as removed.
+    """
+    loop = asyncio.get_running_loop()
+    frontier = deque()
+    seen = set()
+    for s in seeds:
+        if s and s.strip():
+            u = normalize_url(s)
+            if u not in seen:
+                seen.add(u)
+                frontier.append(u)
+    pages = []
+    visited = 0  # pages returned + 304s
+    in_flight = 0
+    cond = asyncio.Condition()
+    host_sems, host_next, robots = {}, {}, {}
+    out = open(out_path, "a", encoding="utf-8") if out_path else None
+    workers = parse_workers if parse_workers is not None else min(4, os.cpu_count() or 1)
+    # spawn, not fork: forking the threaded Streamlit server can copy held locks
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if workers > 0 else None
+
+    def wanted(u: str) -> bool:
+        if not u.startswith("http") or not same_domain(u, allowed_domain):
+            return False
+        return not allow_paths or any(p in u for p in allow_paths)
+
+    async def fetch(client, url, extra_headers):
+        host = urlparse(url).netloc
+        sem = host_sems.setdefault(host, asyncio.Semaphore(per_host))
+        async with sem:
+            # politeness: space request starts per host
+            now = loop.time()
+            start = max(now, host_next.get(host, now))
+            host_next[host] = start + delay
+            if start > now:
+                await asyncio.sleep(start - now)
+            # per-host metrics key: per-URL keys would grow without bound
+            return await arequest(client, "GET", url, headers=extra_headers, endpoint=f"GET {host}")
+
+    async def failed(url):
+        if state is not None and url in state.entries:
+            async with cond:
+                state.mark_failed(url)
+                enqueue(state.links(url))
+
+    async def handle(client, url):
+        nonlocal visited
+        if respect_robots:
+            rp = await _robots_for(client, url, robots)
+            if not rp.can_fetch(client.headers.get("User-Agent", "*"), url):
+                await failed(url)
+                return
+        r = await fetch(client, url, state.conditional_headers(url) if state else None)
+        if state and r.status_code == 304 and url in state.entries:
+            links = state.links(url)
+            async with cond:
+                if visited >= max_pages:
+                    return
+                visited += 1
+                state.not_modified(url)
+                enqueue(links)
+            return
+        if state and r.status_code in (404, 410):
+            state.mark_gone(url)
+            return
+        if r.status_code != 200 or "text/html" not in r.headers.get("Content-Type", ""):
+            await failed(url)
+            return
+        final = normalize_url(str(r.url))
+        parsed = await loop.run_in_executor(pool, parse_page, final, r.text, strip_tags, flat)
+        async with cond:
+            if visited < max_pages and len(parsed["text"]) >= min_chars:
+                visited += 1
+                page = {"url": url, "title": parsed["title"] or url, "text": parsed["text"], "ts": int(time.time())}
+                pages.append(page)
+                if state:
+                    state.record(url, page["text"], parsed["links"],
+                                 r.headers.get("ETag"), r.headers.get("Last-Modified"))
+                if out:
+                    out.write(json.dumps(page, ensure_ascii=False) + "\n")
+            enqueue(parsed["links"])
+
+    def enqueue(links):
+        # caller holds `cond`
+        for nxt in links:
+            if nxt not in seen and wanted(nxt) and len(frontier) < max_frontier:
+                seen.add(nxt)
+                frontier.append(nxt)
+
+    async def worker(client):
+        nonlocal in_flight
+        while True:
+            async with cond:
+                await cond.wait_for(lambda: frontier or in_flight == 0 or visited >= max_pages)
+                if visited >= max_pages or not frontier:
+                    cond.notify_all()
+                    return
+                url = frontier.popleft()
+                in_flight += 1
+            try:
+                await handle(client, url)
+            except Exception:
+                await failed(url)
+            finally:
+                async with cond:
+                    in_flight -= 1
+                    cond.notify_all()
+
+    try:
+        async with make_async_client(concurrency, headers=headers or HEADERS, timeout=timeout) as client:
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        if state is not None:
+            state.complete = visited < max_pages and not frontier
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if out:
+            out.close()
     return pages
 
+def run_crawl(seeds, **kwargs):
+    """Blocking entry point for crawl_async (Streamlit handlers have no running loop)."""
+    return asyncio.run(crawl_async(seeds, **kwargs))
+
+def crawl_urls(seeds, allowed_domain="pgrkam.com", max_pages=30, timeout=15):
+    return run_crawl(seeds, allowed_domain=allowed_domain, max_pages=max_pages,
+                     timeout=timeout, min_chars=200)  # skip tiny pages
+
 def chunk_pages(pages, max_chars=1200, overlap=200):
     chunks, metas = [], []
     for p in pages:
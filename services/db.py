@@ -1,11 +1,39 @@
 # services/db.py
-import os, time
-from typing import Optional, Dict, Any
-from sqlalchemy import create_engine, text
+import os, json, time, queue, atexit, logging, threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import IntegrityError
+
+log = logging.getLogger(__name__)
 
 DB_PATH = os.environ.get("DB_PATH", "sqlite:///pgrkam.db")
 engine = create_engine(DB_PATH, future=True)
 
+# applied to every new SQLite connection: WAL lets readers run alongside the writer,
+# synchronous=NORMAL fsyncs at checkpoints instead of every commit (safe in WAL mode)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": "-65536",      # KiB → 64 MiB page cache
+    "mmap_size": "268435456",    # 256 MiB memory-mapped reads
+    "temp_store": "MEMORY",
+    "busy_timeout": "5000",      # ms to wait on a locked database instead of failing
+}
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_con, _record):
+        cur = dbapi_con.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cur.execute(f"PRAGMA {name}={value}")
+        cur.close()
+
+# write-behind for messages/events (DB_WRITE_BEHIND=0 writes synchronously, e.g. in tests)
+DB_WRITE_BEHIND = os.environ.get("DB_WRITE_BEHIND", "1") != "0"
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "200"))
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "0.5"))  # seconds
+
 # ---------- helpers ----------
 def _col_exists(con, table: str, col: str) -> bool:
     rows = list(con.execute(text(f"PRAGMA table_info({table})")))
@@ -78,6 +106,47 @@ def init_db():
         # user_key already unique by table definition, but create index just in case
         _create_unique_index_if_missing(con, "users", "user_key", "ux_users_userkey")
 
+        # query indexes: admin aggregates by intent / hour, per-user history and events
+        con.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_intent ON messages(intent);"))
+        con.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_ts ON messages(ts);"))
+        con.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_user_ts ON messages(user_key, ts);"))
+        con.execute(text("CREATE INDEX IF NOT EXISTS ix_events_user_name_ts ON events(user_key, name, ts);"))
+
+        # ---- analytics rollups (maintained by refresh_rollups) ----
+        con.execute(text("""
+        CREATE TABLE IF NOT EXISTS rollup_hourly (
+          hour INTEGER,                   -- epoch seconds, start of UTC hour
+          intent TEXT,
+          lang TEXT,
+          count INTEGER,
+          PRIMARY KEY (hour, intent, lang)
+        );
+        """))
+        con.execute(text("""
+        CREATE TABLE IF NOT EXISTS rollup_daily_users (
+          day TEXT,                       -- YYYY-MM-DD (UTC)
+          user_key TEXT,
+          PRIMARY KEY (day, user_key)
+        );
+        """))
+        con.execute(text("""
+        CREATE TABLE IF NOT EXISTS rollup_rag_daily (
+          day TEXT,
+          rag INTEGER,                    -- 1 = answered with the knowledge base
+          count INTEGER,
+          PRIMARY KEY (day, rag)
+        );
+        """))
+        con.execute(text("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+          source TEXT PRIMARY KEY,        -- 'messages' / 'events'
+          last_id INTEGER
+        );
+        """))
+        con.execute(text("""
+        INSERT OR IGNORE INTO rollup_state(source, last_id) VALUES ('messages', 0), ('events', 0);
+        """))
+
 # ---------- write ops ----------
 def upsert_user(
     user_key: str,
@@ -86,6 +155,7 @@ def upsert_user(
     prefs_json: str = ""
 ):
     """Legacy compatibility (original signature)."""
+    _forget_user(user_key)
     now = int(time.time())
     with engine.begin() as con:
         con.execute(text("""
@@ -107,6 +177,7 @@ def upsert_user_profile(
     prefs_json: str = ""
 ):
     """Auth-aware upsert (use this in app.py for login/registration)."""
+    _forget_user(user_key, email)
     now = int(time.time())
     # Normalize empties to None
     email = email or None
@@ -140,28 +211,218 @@ def upsert_user_profile(
         set_sql = ", ".join(sets)
         con.execute(text(f"UPDATE users SET {set_sql} WHERE user_key=:uk"), params)
 
-def insert_message(user_key: str, role: str, content: str, intent: str = "", meta_json: str = ""):
-    with engine.begin() as con:
-        con.execute(text("""
+_INSERT_SQL = {
+    "messages": """
         INSERT INTO messages(user_key,role,content,intent,meta_json,ts)
         VALUES (:uk,:r,:c,:i,:m,:ts)
-        """), {"uk": user_key, "r": role, "c": content, "i": intent, "m": meta_json, "ts": int(time.time())})
-
-def log_event(user_key: str, name: str, value: float = 0.0, payload: str = ""):
-    with engine.begin() as con:
-        con.execute(text("""
+        """,
+    "events": """
         INSERT INTO events(user_key,name,value,payload,ts)
         VALUES (:uk,:n,:v,:p,:ts)
-        """), {"uk": user_key, "n": name, "v": value, "p": payload, "ts": int(time.time())})
+        """,
+}
+
+def _write_rows(rows: List[Tuple[str, Dict[str, Any]]]):
+    """One transaction; rows grouped per table and inserted with executemany."""
+    by_table: Dict[str, List[Dict[str, Any]]] = {}
+    for table, params in rows:
+        by_table.setdefault(table, []).append(params)
+    with engine.begin() as con:
+        for table, params in by_table.items():
+            con.execute(text(_INSERT_SQL[table]), params)
+
+class _WriteBehind:
+    """
+    Background writer: rows are queued by insert_message/log_event and written
+    by one daemon thread in batches of up to `batch_size`, or whatever arrived
+    within `interval` seconds of the first queued row. Timestamps are taken at
+    enqueue time. A batch that still fails after retries is counted in
+    `dropped` (with `last_error`) so a broken database cannot wedge the app.
+    """
+    def __init__(self, batch_size: int = DB_BATCH_SIZE, interval: float = DB_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.q: "queue.Queue" = queue.Queue()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def put(self, table: str, params: Dict[str, Any]):
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+                self.thread.start()
+        self.q.put((table, params))
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Block until everything queued so far is written; False on timeout."""
+        if self.thread is None or not self.thread.is_alive():
+            return self.q.empty()
+        done = threading.Event()
+        self.q.put(done)
+        return done.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch, waiters = [], []
+            item = self.q.get()
+            deadline = time.monotonic() + self.interval
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)  # flush marker: write what we have now
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for w in waiters:
+                w.set()
+
+    def _write(self, batch, attempts: int = 3):
+        for i in range(attempts):
+            try:
+                _write_rows(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:  # e.g. "database is locked"
+                self.last_error = repr(e)
+                time.sleep(0.1 * 2 ** i)
+        self.dropped += len(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": self.q.qsize(), "written": self.written, "dropped": self.dropped,
+                "last_error": self.last_error}
+
+_writer = _WriteBehind()
+atexit.register(_writer.flush)
+
+def set_write_behind(enabled: bool):
+    """Switch between queued and synchronous writes (flushes the queue when disabling)."""
+    global DB_WRITE_BEHIND
+    if not enabled:
+        _writer.flush()
+    DB_WRITE_BEHIND = enabled
+
+def flush_writes(timeout: float = 10.0) -> bool:
+    """Wait for queued messages/events to reach the database."""
+    return _writer.flush(timeout)
+
+def write_stats() -> Dict[str, Any]:
+    return _writer.stats()
+
+def _insert(table: str, params: Dict[str, Any]):
+    if DB_WRITE_BEHIND:
+        _writer.put(table, params)
+    else:
+        _write_rows([(table, params)])
+
+def insert_message(user_key: str, role: str, content: str, intent: str = "", meta_json: str = ""):
+    _insert("messages", {"uk": user_key, "r": role, "c": content, "i": intent, "m": meta_json, "ts": int(time.time())})
+
+def log_event(user_key: str, name: str, value: float = 0.0, payload: str = ""):
+    _insert("events", {"uk": user_key, "n": name, "v": value, "p": payload, "ts": int(time.time())})
+
+def create_account(user_key: str, email: str, name: str, pass_hash: str,
+                   created_at: Optional[int] = None) -> bool:
+    """
+    Register email/name/pass_hash on the users row for `user_key` (created if
+    missing; existing prefs are kept). False if the email is already taken.
+    """
+    _forget_user(user_key, email)
+    try:
+        with engine.begin() as con:
+            con.execute(text("""
+            INSERT INTO users(user_key,email,name,pass_hash,created_at)
+            VALUES (:uk,:em,:nm,:ph,:ts)
+            ON CONFLICT(user_key) DO UPDATE SET
+              email=excluded.email,
+              name=excluded.name,
+              pass_hash=excluded.pass_hash;
+            """), {"uk": user_key, "em": email, "nm": name, "ph": pass_hash,
+                   "ts": created_at or int(time.time())})
+    except IntegrityError:  # ux_users_email
+        return False
+    return True
+
+def migrate_accounts_json(path: str = "users.json") -> int:
+    """
+    One-time import of the legacy JSON account store ({email: {user_id, name,
+    pass_hash, created_at}}) into users; the file is renamed to
+    `<path>.migrated` afterwards. Malformed entries are logged and skipped.
+    Returns the number of accounts imported.
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            accounts = json.load(f)
+    except Exception:
+        log.warning("Could not read legacy accounts from %s", path, exc_info=True)
+        return 0
+    if not isinstance(accounts, dict):
+        log.warning("Legacy accounts file %s is not a JSON object; not migrated", path)
+        return 0
+    imported = 0
+    for email, entry in accounts.items():
+        if not isinstance(entry, dict) or not entry.get("user_id") or not entry.get("pass_hash"):
+            log.warning("Skipping malformed legacy account %r in %s", email, path)
+            continue
+        if get_user_by_email(email):
+            continue
+        if create_account(entry["user_id"], email, entry.get("name") or "", entry["pass_hash"],
+                          entry.get("created_at")):
+            imported += 1
+    os.replace(path, path + ".migrated")
+    return imported
 
 # ---------- read ops ----------
+def explain(sql: str, params: Optional[Dict[str, Any]] = None) -> List[str]:
+    """SQLite EXPLAIN QUERY PLAN details, e.g. to confirm a query uses an index."""
+    with engine.begin() as con:
+        return [r[-1] for r in con.execute(text("EXPLAIN QUERY PLAN " + sql), params or {})]
+
+# small read cache for account lookups (login reruns hit the same rows)
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60.0  # seconds; other processes' writes become visible after this
+_user_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()  # found rows only
+_user_cache_lock = threading.Lock()
+
+def _forget_user(user_key: str = None, email: str = None):
+    with _user_cache_lock:
+        for em in [em for em, (_, row) in _user_cache.items() if em == email or row["user_key"] == user_key]:
+            del _user_cache[em]
+
 def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
+    now = time.time()
+    with _user_cache_lock:
+        hit = _user_cache.get(email)
+        if hit is not None and now - hit[0] < USER_CACHE_TTL:
+            _user_cache.move_to_end(email)
+            return dict(hit[1])
     with engine.begin() as con:
         row = con.execute(text("""
         SELECT id,user_key,email,name,pass_hash,lang,district,prefs_json,created_at
         FROM users WHERE email=:em
         """), {"em": email}).mappings().first()
-        return dict(row) if row else None
+    if not row:
+        return None
+    row = dict(row)
+    with _user_cache_lock:
+        _user_cache[email] = (now, row)
+        _user_cache.move_to_end(email)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return dict(row)
 
 def get_user_by_key(user_key: str) -> Optional[Dict[str, Any]]:
     with engine.begin() as con:
@@ -179,3 +440,86 @@ def verify_login(email: str, pass_hash: str) -> Optional[Dict[str, Any]]:
         FROM users WHERE email=:em AND pass_hash=:ph
         """), {"em": email, "ph": pass_hash}).mappings().first()
         return dict(row) if row else None
+
+# ---------- analytics rollups ----------
+def refresh_rollups() -> Dict[str, int]:
+    """
+    Fold messages/events rows added since the last call (ids above the
+    high-water marks in rollup_state) into the rollup tables. Returns the
+    number of new rows folded per source.
+    """
+    with engine.begin() as con:
+        # write first: takes the write lock, so concurrent refreshes cannot double count
+        con.execute(text("UPDATE rollup_state SET last_id=last_id"))
+        marks = dict(con.execute(text("SELECT source, last_id FROM rollup_state")).all())
+        hi_m = con.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+        hi_e = con.execute(text("SELECT COALESCE(MAX(id), 0) FROM events")).scalar()
+        lo_m, lo_e = marks.get("messages", 0), marks.get("events", 0)
+
+        if hi_m > lo_m:
+            con.execute(text("""
+            INSERT INTO rollup_hourly(hour, intent, lang, count)
+            SELECT (ts / 3600) * 3600, COALESCE(intent, ''),
+                   COALESCE(CASE WHEN json_valid(meta_json) THEN json_extract(meta_json, '$.lang') END, ''),
+                   COUNT(*)
+            FROM messages WHERE id > :lo AND id <= :hi
+            GROUP BY 1, 2, 3
+            ON CONFLICT(hour, intent, lang) DO UPDATE SET count = count + excluded.count;
+            """), {"lo": lo_m, "hi": hi_m})
+            con.execute(text("""
+            INSERT OR IGNORE INTO rollup_daily_users(day, user_key)
+            SELECT DISTINCT date(ts, 'unixepoch'), user_key
+            FROM messages WHERE id > :lo AND id <= :hi AND role = 'user';
+            """), {"lo": lo_m, "hi": hi_m})
+        if hi_e > lo_e:
+            con.execute(text("""
+            INSERT INTO rollup_rag_daily(day, rag, count)
+            SELECT date(ts, 'unixepoch'),
+                   CASE WHEN json_valid(payload) AND json_extract(payload, '$.rag') THEN 1 ELSE 0 END,
+                   COUNT(*)
+            FROM events WHERE id > :lo AND id <= :hi AND name = 'ask'
+            GROUP BY 1, 2
+            ON CONFLICT(day, rag) DO UPDATE SET count = count + excluded.count;
+            """), {"lo": lo_e, "hi": hi_e})
+        con.execute(text("UPDATE rollup_state SET last_id=:m WHERE source='messages'"), {"m": max(hi_m, lo_m)})
+        con.execute(text("UPDATE rollup_state SET last_id=:e WHERE source='events'"), {"e": max(hi_e, lo_e)})
+    return {"messages": max(0, hi_m - lo_m), "events": max(0, hi_e - lo_e)}
+
+def rollup_intents():
+    """[(intent, count)] over all messages with an intent, most frequent first."""
+    with engine.begin() as con:
+        return con.execute(text("""
+        SELECT intent, SUM(count) cnt FROM rollup_hourly
+        WHERE intent != '' GROUP BY intent ORDER BY cnt DESC
+        """)).all()
+
+def rollup_hourly_counts():
+    """[("YYYY-MM-DD HH:00", count)] of messages per UTC hour."""
+    with engine.begin() as con:
+        return con.execute(text("""
+        SELECT strftime('%Y-%m-%d %H:00', hour, 'unixepoch') h, SUM(count) c
+        FROM rollup_hourly GROUP BY hour ORDER BY hour
+        """)).all()
+
+def rollup_langs():
+    """[(lang, count)] of messages per detected language."""
+    with engine.begin() as con:
+        return con.execute(text("""
+        SELECT CASE WHEN lang = '' THEN 'unknown' ELSE lang END, SUM(count) c
+        FROM rollup_hourly GROUP BY lang ORDER BY c DESC
+        """)).all()
+
+def rollup_daily_active_users():
+    """[(day, active users)]."""
+    with engine.begin() as con:
+        return con.execute(text("""
+        SELECT day, COUNT(*) FROM rollup_daily_users GROUP BY day ORDER BY day
+        """)).all()
+
+def rollup_rag_ratio():
+    """[(day, rag asks, non-rag asks)]."""
+    with engine.begin() as con:
+        return con.execute(text("""
+        SELECT day, SUM(CASE WHEN rag = 1 THEN count ELSE 0 END), SUM(CASE WHEN rag = 0 THEN count ELSE 0 END)
+        FROM rollup_rag_daily GROUP BY day ORDER BY day
+        """)).all()
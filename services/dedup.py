@@ -0,0 +1,98 @@
+# services/dedup.py
+import os
+import re
+import zlib
+import hashlib
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple
+
+# Jaccard similarity (char 5-gram shingles) above which a chunk is a near-duplicate; 0 disables.
+# Meant for boilerplate (headers, footers, repeated notices): at 0.9 two job-mela
+# notices differing only in date or district already collapse into one.
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.98"))
+
+_PRIME = np.uint64(4294967311)  # > 2^32, so (a*x + b) stays below 2^64 for 31-bit a, b
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", (text or "").lower()).strip()
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, shingle: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.a = rng.integers(1, 2**31 - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 2**31 - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        t = _normalize(text)
+        n = max(1, len(t) - self.shingle + 1)
+        shingles = {zlib.crc32(t[i:i + self.shingle].encode("utf-8")) for i in range(n)}
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        return ((np.outer(x, self.a) + self.b) % _PRIME).min(axis=0)
+
+class NearDupFilter:
+    """
+    MinHash + LSH banding index over chunk keys. `check` returns the key of an
+    already registered chunk whose estimated Jaccard similarity is at least
+    `threshold`, else None. Exact duplicates (after whitespace/case
+    normalization) are caught before hashing.
+    """
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = 64, bands: int = 8):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.sigs: Dict[int, np.ndarray] = {}
+        self._buckets: List[Dict[bytes, Set[int]]] = [{} for _ in range(bands)]
+        self._exact: Dict[str, int] = {}
+        self._exact_of: Dict[int, str] = {}
+
+    def __len__(self):
+        return len(self.sigs)
+
+    def _band_keys(self, sig: np.ndarray) -> List[bytes]:
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def check(self, text: str) -> Tuple[Optional[int], str, np.ndarray]:
+        """Returns (canonical_key or None, exact_hash, signature) for a later add()."""
+        exact = hashlib.blake2b(_normalize(text).encode("utf-8"), digest_size=16).hexdigest()
+        if exact in self._exact:
+            return self._exact[exact], exact, None
+        sig = self.hasher.signature(text)
+        best, best_sim = None, self.threshold
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            candidates |= bucket.get(key, set())
+        for cand in candidates:
+            sim = float(np.mean(self.sigs[cand] == sig))
+            if sim >= best_sim:
+                best, best_sim = cand, sim
+        return best, exact, sig
+
+    def add(self, key: int, exact: str, sig: Optional[np.ndarray]):
+        """Register `key`; sig is None when check() found an exact duplicate of another key."""
+        self._exact_of[key] = exact
+        if sig is None:
+            self._exact.setdefault(exact, key)
+            return
+        self._exact[exact] = key
+        self.sigs[key] = sig
+        for bucket, bkey in zip(self._buckets, self._band_keys(sig)):
+            bucket.setdefault(bkey, set()).add(key)
+
+    def remove(self, key: int):
+        sig = self.sigs.pop(key, None)
+        exact = self._exact_of.pop(key, None)
+        if exact is not None and self._exact.get(exact) == key:
+            del self._exact[exact]
+        if sig is None:
+            return
+        for bucket, bkey in zip(self._buckets, self._band_keys(sig)):
+            members = bucket.get(bkey)
+            if members:
+                members.discard(key)
+                if not members:
+                    del bucket[bkey]
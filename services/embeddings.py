@@ -1,22 +1,226 @@
-# services/embeddings.py
 from sentence_transformers import SentenceTransformer
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
-from typing import List
+from typing import List, Optional, Dict
 
 # multilingual, light-weight, great on CPU
 _EMB_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 _model = None
 
+# persistent embedding cache (set EMB_CACHE_SIZE=0 to disable)
+EMB_CACHE_DIR = os.environ.get("EMB_CACHE_DIR", "data/emb_cache")
+EMB_CACHE_SIZE = int(os.environ.get("EMB_CACHE_SIZE", "50000"))
+# the key map is rewritten after this many new vectors or seconds (and at exit), not per call
+EMB_CACHE_FLUSH_EVERY = int(os.environ.get("EMB_CACHE_FLUSH_EVERY", "512"))
+EMB_CACHE_FLUSH_SECS = float(os.environ.get("EMB_CACHE_FLUSH_SECS", "60"))
+_cache = None
+_cache_lock = threading.Lock()
+
 def get_model():
     global _model
     if _model is None:
         _model = SentenceTransformer(_EMB_MODEL_NAME)
     return _model
 
-def embed_texts(texts: List[str]) -> np.ndarray:
+def model_name() -> str:
+    return _EMB_MODEL_NAME
+
+def text_key(text: str) -> str:
+    """Cache key for a text: hash of its whitespace-normalized form."""
+    norm = " ".join((text or "").split())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).hexdigest()
+
+# ---------- cache ----------
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, fall back to one dir per process
+    fcntl = None
+
+def _claim_dir(base: str, slug: str):
+    """
+    (dir, lock file) for a cache writer: `base` if no other live process holds
+    its lock, else the first free `base/w1`, `base/w2`, ... Each worker
+    process thus owns one directory and reuses it after a restart.
+    """
+    if fcntl is None:
+        d = os.path.join(base, f"pid{os.getpid()}")
+        os.makedirs(d, exist_ok=True)
+        return d, None
+    for n in range(64):
+        d = base if n == 0 else os.path.join(base, f"w{n}")
+        os.makedirs(d, exist_ok=True)
+        f = open(os.path.join(d, f"{slug}.lock"), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return d, f
+        except OSError:
+            f.close()
+    raise RuntimeError(f"No free embedding cache directory under {base}")
+
+class EmbeddingCache:
+    """
+    Content-addressed store of normalized float32 embeddings for one model.
+
+    Vectors live in a fixed-capacity float32 memmap (`<model>.f32`); the
+    key -> slot map is kept in LRU order and persisted to `<model>.keys.json`.
+    When full, a batch of least recently used slots is freed. Single writer per
+    directory: a process that finds `cache_dir` locked by another one uses a
+    sibling directory (see _claim_dir). flush() persists the key map; it is
+    called by maybe_flush() every `flush_every` new vectors / `flush_secs`
+    seconds, and at exit.
+    """
+    def __init__(self, model: str, dim: int, cache_dir: str = EMB_CACHE_DIR, capacity: int = EMB_CACHE_SIZE,
+                 flush_every: int = EMB_CACHE_FLUSH_EVERY, flush_secs: float = EMB_CACHE_FLUSH_SECS):
+        slug = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        cache_dir, self._lock_file = _claim_dir(cache_dir, slug)
+        self.dir = cache_dir
+        self.model = model
+        self.dim = dim
+        self.capacity = capacity
+        self.vec_path = os.path.join(cache_dir, f"{slug}.f32")
+        self.keys_path = os.path.join(cache_dir, f"{slug}.keys.json")
+        self.slots: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = 0  # vectors written since the last flush
+        self._flushed_at = time.monotonic()
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.lock = threading.Lock()
+
+        header = None
+        if os.path.exists(self.keys_path) and os.path.exists(self.vec_path):
+            try:
+                with open(self.keys_path, "r", encoding="utf-8") as f:
+                    header = json.load(f)
+            except Exception:
+                header = None
+        if header and header.get("dim") == dim and header.get("capacity") == capacity:
+            self.vecs = np.memmap(self.vec_path, dtype="float32", mode="r+", shape=(capacity, dim))
+            self.slots = OrderedDict((k, int(s)) for k, s in header.get("slots", []))
+        else:
+            # new cache (or dim/capacity changed) → start empty
+            self.vecs = np.memmap(self.vec_path, dtype="float32", mode="w+", shape=(capacity, dim))
+        used = set(self.slots.values())
+        self._free = [s for s in range(capacity - 1, -1, -1) if s not in used]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        self.slots.move_to_end(key)
+        return self.vecs[slot]
+
+    def put(self, key: str, vec: np.ndarray):
+        slot = self.slots.get(key)
+        if slot is None:
+            if not self._free:
+                self._evict()
+            slot = self._free.pop()
+        self.vecs[slot] = vec
+        self.slots[key] = slot
+        self.slots.move_to_end(key)
+        self._dirty += 1
+
+    def _evict(self):
+        # free a batch of LRU slots and persist the key map before any is
+        # overwritten, so a crash never leaves a saved key on another text's vector
+        for _ in range(min(len(self.slots), max(1, self.flush_every))):
+            _, slot = self.slots.popitem(last=False)
+            self._free.append(slot)
+        self._dirty += 1
+        self.flush()
+
+    def maybe_flush(self):
+        if self._dirty >= self.flush_every or (
+                self._dirty and time.monotonic() - self._flushed_at >= self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        self.vecs.flush()
+        tmp = self.keys_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "model": self.model,
+                "dim": self.dim,
+                "capacity": self.capacity,
+                "slots": list(self.slots.items()),
+            }, f)
+        os.replace(tmp, self.keys_path)
+        self._dirty = 0
+        self._flushed_at = time.monotonic()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.slots), "capacity": self.capacity}
+
+def get_cache() -> Optional[EmbeddingCache]:
+    global _cache
+    if EMB_CACHE_SIZE <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            dim = get_model().get_sentence_embedding_dimension()
+            _cache = EmbeddingCache(_EMB_MODEL_NAME, dim)
+            atexit.register(_flush_at_exit)
+    return _cache
+
+def _flush_at_exit():
+    if _cache is not None:
+        with _cache.lock:
+            _cache.flush()
+
+def cache_stats() -> Dict[str, int]:
+    """Hit/miss counters since process start (zeros if the cache is disabled)."""
+    cache = get_cache()
+    if cache is None:
+        return {"hits": 0, "misses": 0, "size": 0, "capacity": 0}
+    return cache.stats()
+
+# ---------- encode ----------
+def _encode(texts: List[str]) -> np.ndarray:
     model = get_model()
     vecs = model.encode(texts, normalize_embeddings=True, show_progress_bar=False)
     return np.array(vecs).astype("float32")
 
+def embed_texts(texts: List[str]) -> np.ndarray:
+    cache = get_cache()
+    if cache is None:
+        return _encode(texts)
+
+    keys = [text_key(t) for t in texts]
+    out = np.empty((len(texts), cache.dim), dtype="float32")
+    missing: "OrderedDict[str, List[int]]" = OrderedDict()
+    with cache.lock:
+        for i, k in enumerate(keys):
+            vec = cache.get(k)
+            if vec is None:
+                missing.setdefault(k, []).append(i)
+            else:
+                out[i] = vec
+                cache.hits += 1
+        cache.misses += sum(len(pos) for pos in missing.values())
+
+    if missing:
+        # encode each distinct missing text once, outside the lock
+        miss_vecs = _encode([texts[pos[0]] for pos in missing.values()])
+        with cache.lock:
+            for (k, pos), vec in zip(missing.items(), miss_vecs):
+                out[pos] = vec
+                cache.put(k, vec)
+            cache.maybe_flush()
+    return out
+
 def embed_one(text: str) -> np.ndarray:
     return embed_texts([text])[0]
@@ -0,0 +1,211 @@
+# services/http_client.py
+# Shared outbound HTTP: one keep-alive connection pool per process (HTTP/2 when
+# the optional `h2` package is installed), jittered exponential backoff that
+# honours Retry-After on 429/5xx, and per-endpoint latency metrics.
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlparse
+import httpx
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "20"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "20"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# raised before the request reached the server, so even a POST is safe to resend
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+def _limits(max_connections: int = MAX_CONNECTIONS) -> httpx.Limits:
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                        keepalive_expiry=30)
+
+def get_client() -> httpx.Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(http2=HTTP2, limits=_limits(), timeout=HTTP_TIMEOUT, follow_redirects=True)
+    return _client
+
+def make_async_client(max_connections: int = MAX_CONNECTIONS, **kwargs) -> httpx.AsyncClient:
+    """Async clients are bound to one event loop, so callers own their lifetime."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    kwargs.setdefault("follow_redirects", True)
+    return httpx.AsyncClient(http2=HTTP2, limits=_limits(max_connections), **kwargs)
+
+# ---------- backoff ----------
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, overridden by the server's Retry-After."""
+    server = retry_after_seconds(retry_after)
+    if server is not None:
+        return min(server, BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+def _retryable(method: str, exc: httpx.TransportError) -> bool:
+    """
+    Idempotent requests are retried on any transport error; others (LLM POSTs)
+    only on connect-phase errors: after a read timeout the server may still
+    be generating, and a resend would pay for the completion twice.
+    """
+    return method.upper() in IDEMPOTENT_METHODS or isinstance(exc, CONNECT_ERRORS)
+
+# ---------- metrics ----------
+class _Stats:
+    __slots__ = ("count", "errors", "retries", "total_ms", "max_ms", "recent")
+
+    def __init__(self):
+        self.count = self.errors = self.retries = 0
+        self.total_ms = self.max_ms = 0.0
+        self.recent = deque(maxlen=500)
+
+_metrics: Dict[str, _Stats] = {}
+_metrics_lock = threading.Lock()
+
+def _endpoint(method: str, url: str) -> str:
+    p = urlparse(str(url))
+    return f"{method.upper()} {p.netloc}{p.path}"
+
+def _record(endpoint: str, ms: float, error: bool = False, retry: bool = False):
+    with _metrics_lock:
+        s = _metrics.setdefault(endpoint, _Stats())
+        if retry:
+            s.retries += 1
+            return
+        s.count += 1
+        s.errors += int(error)
+        s.total_ms += ms
+        s.max_ms = max(s.max_ms, ms)
+        s.recent.append(ms)
+
+def latency_stats() -> Dict[str, Dict[str, float]]:
+    """Per endpoint: calls, errors, retries, mean/p50/p95/max latency (ms, final attempts)."""
+    out = {}
+    with _metrics_lock:
+        for ep, s in _metrics.items():
+            recent = sorted(s.recent)
+            pick = lambda q: recent[min(len(recent) - 1, int(q * len(recent)))] if recent else 0.0
+            out[ep] = {
+                "count": s.count, "errors": s.errors, "retries": s.retries,
+                "mean_ms": s.total_ms / s.count if s.count else 0.0,
+                "p50_ms": pick(0.50), "p95_ms": pick(0.95), "max_ms": s.max_ms,
+            }
+    return out
+
+def reset_stats():
+    with _metrics_lock:
+        _metrics.clear()
+
+# ---------- requests ----------
+def request(method: str, url: str, retries: int = HTTP_RETRIES, endpoint: str = None, **kwargs) -> httpx.Response:
+    """
+    client.request with retries on transport errors (see _retryable) and
+    RETRY_STATUS responses.
+    The last response is returned as-is (callers check status), the last
+    transport error is raised.
+    """
+    client = get_client()
+    endpoint = endpoint or _endpoint(method, url)
+    for attempt in range(retries + 1):
+        t0 = time.perf_counter()
+        try:
+            resp = client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= retries or not _retryable(method, e):
+                _record(endpoint, (time.perf_counter() - t0) * 1000, error=True)
+                raise
+            _record(endpoint, 0, retry=True)
+            time.sleep(backoff_delay(attempt))
+            continue
+        ms = (time.perf_counter() - t0) * 1000
+        if resp.status_code in RETRY_STATUS and attempt < retries:
+            _record(endpoint, ms, retry=True)
+            time.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
+            continue
+        _record(endpoint, ms, error=resp.status_code >= 400)
+        return resp
+
+@contextmanager
+def stream(method: str, url: str, retries: int = HTTP_RETRIES, endpoint: str = None, **kwargs):
+    """
+    Streaming variant of request(): retries happen before the body is read;
+    latency is time to response headers.
+    """
+    client = get_client()
+    endpoint = endpoint or _endpoint(method, url)
+    for attempt in range(retries + 1):
+        t0 = time.perf_counter()
+        try:
+            cm = client.stream(method, url, **kwargs)
+            resp = cm.__enter__()
+        except httpx.TransportError as e:
+            if attempt >= retries or not _retryable(method, e):
+                _record(endpoint, (time.perf_counter() - t0) * 1000, error=True)
+                raise
+            _record(endpoint, 0, retry=True)
+            time.sleep(backoff_delay(attempt))
+            continue
+        ms = (time.perf_counter() - t0) * 1000
+        if resp.status_code in RETRY_STATUS and attempt < retries:
+            cm.__exit__(None, None, None)
+            _record(endpoint, ms, retry=True)
+            time.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
+            continue
+        _record(endpoint, ms, error=resp.status_code >= 400)
+        try:
+            yield resp
+        finally:
+            cm.__exit__(None, None, None)
+        return
+
+async def arequest(client: httpx.AsyncClient, method: str, url: str, retries: int = HTTP_RETRIES,
+                   endpoint: str = None, **kwargs) -> httpx.Response:
+    """Async request() on a caller-owned client from make_async_client."""
+    endpoint = endpoint or _endpoint(method, url)
+    for attempt in range(retries + 1):
+        t0 = time.perf_counter()
+        try:
+            resp = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= retries or not _retryable(method, e):
+                _record(endpoint, (time.perf_counter() - t0) * 1000, error=True)
+                raise
+            _record(endpoint, 0, retry=True)
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        ms = (time.perf_counter() - t0) * 1000
+        if resp.status_code in RETRY_STATUS and attempt < retries:
+            _record(endpoint, ms, retry=True)
+            await asyncio.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
+            continue
+        _record(endpoint, ms, error=resp.status_code >= 400)
+        return resp
@@ -1,9 +1,9 @@
 # services/ingest.py
-import time, re, json
+import os, re, json, threading, queue
 from pathlib import Path
-from urllib.parse import urljoin, urlparse
-import requests
-from bs4 import BeautifulSoup
+from urllib.parse import urlparse
+from services.crawl import run_crawl, CrawlState
+from services.rag import VectorStore, INDEX_DIR, INDEX_TYPE, EMBED_BATCH
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (compatible; PGRKAM-RAG/1.0; +research-use)"
@@ -14,65 +14,29 @@ def _clean_text(t: str) -> str:
     t = re.sub(r"\s+", " ", t or "").strip()
     return t
 
-def _fetch(url: str, timeout=20):
-    r = requests.get(url, headers=HEADERS, timeout=timeout)
-    r.raise_for_status()
-    return r.text
-
-def _is_same_host(seed:str, href:str)->bool:
-    try:
-        return urlparse(seed).netloc == urlparse(href).netloc
-    except:
-        return False
-
-# ---------- Simple site crawl (breadth-first, limited) ----------
-def crawl(seed_urls, max_pages=40, allow_paths=None):
+# ---------- Site crawl (concurrent BFS, limited) ----------
+def crawl(seed_urls, max_pages=40, allow_paths=None, concurrency=8, per_host=2, state=None):
     """
     seed_urls: list of starting URLs on pgrkam.com
     allow_paths: list of substrings that must appear in URL (e.g., ["/job", "/training"])
+    state: optional CrawlState for conditional (ETag/Last-Modified) recrawls
+    Runs services.crawl.crawl_async; see there for the politeness limits.
     """
-    seen, queue = set(), list(seed_urls)
-    pages = []
-
-    while queue and len(pages) < max_pages:
-        url = queue.pop(0)
-        if url in seen:
-            continue
-        seen.add(url)
-        try:
-            html = _fetch(url)
-        except Exception:
-            continue
-
-        soup = BeautifulSoup(html, "html.parser")
-
-        # extract page text
-        # keep visible text; drop nav/script/style
-        for s in soup(["script","style","noscript"]):
-            s.extract()
-        text = _clean_text(soup.get_text(" "))
-
-        title = _clean_text(soup.title.get_text()) if soup.title else ""
-        pages.append({
-            "url": url,
-            "title": title or url,
-            "text": text,
-            "ts": int(time.time())
-        })
-
-        # discover new links
-        for a in soup.find_all("a", href=True):
-            href = urljoin(url, a["href"])
-            if href.startswith("mailto:") or href.startswith("tel:"):
-                continue
-            if not _is_same_host(seed_urls[0], href):
-                continue
-            if allow_paths and not any(p in href for p in allow_paths):
-                continue
-            if href not in seen and len(pages) + len(queue) < max_pages:
-                queue.append(href)
-
-    return pages
+    if not seed_urls:
+        return []
+    return run_crawl(
+        seed_urls,
+        allowed_domain=urlparse(seed_urls[0]).netloc,
+        max_pages=max_pages,
+        allow_paths=allow_paths,
+        concurrency=concurrency,
+        per_host=per_host,
+        headers=HEADERS,
+        # keep visible text; drop script/style only
+        strip_tags=("script", "style", "noscript"),
+        flat=True,
+        state=state,
+    )
 
 def save_jsonl(pages, out_path="data/pgrkam_pages.jsonl"):
     Path(out_path).parent.mkdir(parents=True, exist_ok=True)
@@ -81,27 +45,37 @@ def save_jsonl(pages, out_path="data/pgrkam_pages.jsonl"):
             f.write(json.dumps(p, ensure_ascii=False) + "\n")
     return out_path
 
-def jsonl_to_chunks(jsonl_path):
-    """Return (chunks, metas) compatible with your VectorStore.build"""
-    chunks, metas = [], []
+def read_jsonl(jsonl_path):
+    pages = []
     with open(jsonl_path, "r", encoding="utf-8") as f:
         for line in f:
-            obj = json.loads(line)
-            url = obj.get("url","")
-            title = obj.get("title","")
-            text = obj.get("text","")
-            if not text: 
+            if line.strip():
+                pages.append(json.loads(line))
+    return pages
+
+def pages_to_chunks(pages):
+    """Return (chunks, metas) compatible with your VectorStore.build"""
+    chunks, metas = [], []
+    for obj in pages:
+        url = obj.get("url","")
+        title = obj.get("title","")
+        text = obj.get("text","")
+        if not text:
+            continue
+        # naive chunking ~800-1200 chars
+        step = 1000
+        for i in range(0, len(text), step):
+            piece = text[i:i+step]
+            if len(piece) < 200:
                 continue
-            # naive chunking ~800-1200 chars
-            step = 1000
-            for i in range(0, len(text), step):
-                piece = text[i:i+step]
-                if len(piece) < 200:
-                    continue
-                chunks.append(piece)
-                metas.append({"source_url": url, "title": title})
+            chunks.append(piece)
+            metas.append({"source_url": url, "title": title})
     return chunks, metas
 
+def jsonl_to_chunks(jsonl_path):
+    """Return (chunks, metas) compatible with your VectorStore.build"""
+    return pages_to_chunks(read_jsonl(jsonl_path))
+
 def ingest_from_web(
     seed_urls,
     allow_paths=None,
@@ -111,3 +85,169 @@ def ingest_from_web(
     pages = crawl(seed_urls, max_pages=max_pages, allow_paths=allow_paths)
     path = save_jsonl(pages, jsonl_out)
     return path
+
+# ---------- Incremental recrawl ----------
+def recrawl(
+    seed_urls,
+    allow_paths=None,
+    max_pages=40,
+    jsonl_out="data/pgrkam_pages.jsonl",
+    state_path=None
+):
+    """
+    Conditional recrawl against the per-URL state stored next to `jsonl_out`.
+    Unchanged (304 / same text hash) and failed (timeout, 5xx, ...) pages keep
+    their previous record; the JSONL is rewritten with the merged pages.
+    Returns (jsonl_path, changes) with changes = {"added", "changed", "removed", "unchanged", "failed"}.
+    """
+    state = CrawlState(state_path or str(Path(jsonl_out).with_suffix(".state.json")))
+    old = {p["url"]: p for p in read_jsonl(jsonl_out)} if Path(jsonl_out).exists() else {}
+    fetched = crawl(seed_urls, max_pages=max_pages, allow_paths=allow_paths, state=state)
+    changes = state.changes()
+
+    merged = dict(old)
+    for url in changes["removed"]:
+        merged.pop(url, None)
+    for p in fetched:
+        merged[p["url"]] = p
+    save_jsonl(list(merged.values()), jsonl_out)
+    state.save()
+    changes["hashes"] = {u: state.hash_of(u) for u in changes["added"] + changes["changed"]}
+    return jsonl_out, changes
+
+def apply_changes(vs, jsonl_path, changes):
+    """
+    Push a recrawl change feed into a VectorStore: removed URLs are dropped,
+    added/changed URLs are re-chunked and re-embedded; nothing else is touched.
+    Returns the number of chunks embedded.
+    """
+    for url in changes.get("removed", []):
+        vs.remove_document(url)
+    todo = set(changes.get("added", [])) | set(changes.get("changed", []))
+    if not todo:
+        return 0
+    hashes = changes.get("hashes", {})
+    embedded = 0
+    for page in read_jsonl(jsonl_path):
+        url = page.get("url", "")
+        if url not in todo:
+            continue
+        chunks, metas = pages_to_chunks([page])
+        embedded += len(vs.replace_document(url, chunks, metas, source_hash=hashes.get(url)))
+    return embedded
+
+# ---------- Streaming JSONL -> index pipeline ----------
+def iter_jsonl(jsonl_path, start_offset=0):
+    """Yield (end_offset, page) per record, starting at byte `start_offset`."""
+    with open(jsonl_path, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                yield offset, json.loads(line)
+
+def iter_chunk_batches(jsonl_path, batch_size=EMBED_BATCH, start_offset=0):
+    """
+    read -> clean -> chunk, grouped into batches of whole pages holding at
+    least `batch_size` chunks. Yields (texts, metas, end_offset): once a batch
+    is indexed, everything before end_offset is done.
+    """
+    texts, metas, offset = [], [], start_offset
+    for offset, page in iter_jsonl(jsonl_path, start_offset):
+        page = {**page, "text": _clean_text(page.get("text", ""))}
+        chunks, page_metas = pages_to_chunks([page])
+        texts.extend(chunks)
+        metas.extend(page_metas)
+        if len(texts) >= batch_size:
+            yield texts, metas, offset
+            texts, metas = [], []
+    if texts:
+        yield texts, metas, offset
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def stream_jsonl_to_index(
+    jsonl_path="data/pgrkam_pages.jsonl",
+    index_dir=INDEX_DIR,
+    batch_size=EMBED_BATCH,
+    max_pending=4,
+    checkpoint_every=10,
+    index_type=INDEX_TYPE,
+):
+    """
+    Bounded-memory ingest: a reader thread prepares chunk batches into a
+    queue of at most `max_pending` batches (backpressure) while this thread
+    embeds and appends them to the index. Every `checkpoint_every` batches the
+    index is saved to `index_dir` with a checkpoint of the JSONL byte offset,
+    so a crashed run resumes after the last committed batch.
+    The index type follows the growing corpus (VectorStore._maybe_rebuild),
+    so IVF types are trained on the corpus, not on the first batch.
+    Returns the VectorStore.
+    """
+    ckpt_path = Path(index_dir) / "ingest_checkpoint.json"
+    stamp = _file_stamp(jsonl_path)
+    vs, offset, batches = None, 0, 0
+    if ckpt_path.exists():
+        ckpt = json.loads(ckpt_path.read_text(encoding="utf-8"))
+        if ckpt.get("jsonl") == str(jsonl_path) and ckpt.get("stamp") == stamp:
+            try:
+                vs = VectorStore.load(index_dir, mmap=False)
+                offset, batches = ckpt["offset"], ckpt["batches"]
+            except Exception:
+                vs = None
+    if vs is None:
+        vs, offset, batches = VectorStore(index_type=index_type), 0, 0
+
+    def commit(end_offset):
+        vs.save(index_dir)
+        tmp = ckpt_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"jsonl": str(jsonl_path), "stamp": stamp,
+                                   "offset": end_offset, "batches": batches}), encoding="utf-8")
+        os.replace(tmp, ckpt_path)
+
+    q = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    _DONE = object()
+
+    def produce():
+        try:
+            for batch in iter_chunk_batches(jsonl_path, batch_size, offset):
+                while not stop.is_set():
+                    try:
+                        q.put(batch, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put(_DONE)
+        except Exception as e:
+            q.put(e)
+
+    reader = threading.Thread(target=produce, name="jsonl-reader", daemon=True)
+    reader.start()
+    last_offset = offset
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            texts, metas, last_offset = item
+            vs.add_documents(texts, metas)
+            batches += 1
+            if batches % checkpoint_every == 0:
+                commit(last_offset)
+    finally:
+        stop.set()
+        reader.join(timeout=5)
+
+    if vs.index is not None:
+        vs.save(index_dir)
+    if ckpt_path.exists():
+        ckpt_path.unlink()
+    return vs
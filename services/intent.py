@@ -1,6 +1,10 @@
 # services/intent.py
 import re
-from langdetect import detect
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional
+from services.lang import detect_language
 
 INTENTS = [
     "PrivateJobs", "GovernmentJobs", "SkillDevelopment",
@@ -20,18 +24,164 @@ KEYWORDS = {
     "PortalNavigation": ["where", "how to find", "navigate", "page", "link"],
 }
 
+# Hindi / Punjabi (native script and romanized) synonyms, matched like KEYWORDS
+SYNONYMS = {
+    "GovernmentJobs": ["सरकारी", "ਸਰਕਾਰੀ", "sarkari naukri"],
+    "PrivateJobs": ["प्राइवेट", "ਪ੍ਰਾਈਵੇਟ", "निजी", "ਨਿੱਜੀ", "कंपनी", "ਕੰਪਨੀ"],
+    "SkillDevelopment": ["कौशल", "प्रशिक्षण", "ट्रेनिंग", "ਹੁਨਰ", "ਸਿਖਲਾਈ", "ਟ੍ਰੇਨਿੰਗ", "kaushal"],
+    "ForeignCounseling": ["विदेश", "ਵਿਦੇਸ਼", "videsh", "bahar jana"],
+    "JobMela": ["मेला", "ਮੇਲਾ", "rozgar mela"],
+    "RegistrationHelp": ["पंजीकरण", "रजिस्टर", "पासवर्ड", "लॉगिन", "ਰਜਿਸਟਰ", "ਰਜਿਸਟ੍ਰੇਸ਼ਨ", "ਪਾਸਵਰਡ", "ਲੌਗਇਨ"],
+    "EligibilityQuery": ["योग्यता", "पात्रता", "उम्र सीमा", "ਯੋਗਤਾ", "ਉਮਰ ਸੀਮਾ"],
+    "DocumentChecklist": ["दस्तावेज़", "प्रमाण पत्र", "ਦਸਤਾਵੇਜ਼", "ਸਰਟੀਫਿਕੇਟ"],
+    "PortalNavigation": ["कहाँ", "कहां", "लिंक", "ਕਿੱਥੇ", "ਲਿੰਕ"],
+}
+
+FALLBACK_JOB_WORDS = ("job", "vacancy", "नौकरी", "ਨੌਕਰੀ", "naukri")
+
+# labelled examples for the optional embedding classifier
+EXAMPLES = {
+    "GovernmentJobs": ["latest punjab government jobs", "सरकारी नौकरी की भर्ती", "ਪੰਜਾਬ ਸਰਕਾਰੀ ਨੌਕਰੀਆਂ"],
+    "PrivateJobs": ["companies hiring freshers in mohali", "प्राइवेट कंपनी में नौकरी", "ਪ੍ਰਾਈਵੇਟ ਨੌਕਰੀ ਲੁਧਿਆਣਾ"],
+    "SkillDevelopment": ["free computer course near me", "कौशल विकास प्रशिक्षण", "ਹੁਨਰ ਸਿਖਲਾਈ ਕੋਰਸ"],
+    "ForeignCounseling": ["how to go abroad for work", "विदेश में पढ़ाई के लिए सलाह", "ਵਿਦੇਸ਼ ਜਾਣ ਲਈ ਸਲਾਹ"],
+    "JobMela": ["upcoming job fair dates", "रोजगार मेला कब है", "ਰੋਜ਼ਗਾਰ ਮੇਲਾ ਕਦੋਂ ਹੈ"],
+    "RegistrationHelp": ["i forgot my password", "पंजीकरण कैसे करें", "ਰਜਿਸਟਰ ਕਿਵੇਂ ਕਰੀਏ"],
+    "EligibilityQuery": ["am i eligible for this post", "इस पद के लिए योग्यता", "ਉਮਰ ਸੀਮਾ ਕੀ ਹੈ"],
+    "DocumentChecklist": ["which documents are required", "कौन से दस्तावेज़ चाहिए", "ਕਿਹੜੇ ਦਸਤਾਵੇਜ਼ ਲੋੜੀਂਦੇ ਹਨ"],
+    "PortalNavigation": ["where is the jobs page", "वेबसाइट पर कहाँ मिलेगा", "ਵੈਬਸਾਈਟ ਤੇ ਕਿੱਥੇ ਮਿਲੇਗਾ"],
+    "GeneralFAQ": ["what is pgrkam", "यह पोर्टल क्या है", "ਇਹ ਪੋਰਟਲ ਕੀ ਹੈ"],
+}
+
 def detect_lang(text: str) -> str:
-    try:
-        return detect(text)
-    except Exception:
-        return "en"
+    # script fast path + seeded langdetect fallback, see services.lang
+    return detect_language(text)
+
+# ---------- keyword matcher ----------
+def _norm(text: str) -> str:
+    # NFC so precomposed and combining nukta forms (ਜ਼ / ਜ਼) compare equal
+    return unicodedata.normalize("NFC", text or "").lower()
+
+_WORD = r"[\w\u0900-\u097F\u0A00-\u0A7F]"  # \w misses Indic vowel signs, so \b breaks inside words
+_INTENT_OF: Dict[str, str] = {}
+for _intent, _words in KEYWORDS.items():
+    for _w in _words + SYNONYMS.get(_intent, []):
+        _INTENT_OF.setdefault(_norm(_w), _intent)
+_RANK = {intent: i for i, intent in enumerate(KEYWORDS)}
+# one alternation, longest keywords first so "punjab govt" wins over "gov"
+_MATCHER = re.compile(
+    rf"(?<!{_WORD})(" + "|".join(re.escape(w) for w in sorted(_INTENT_OF, key=len, reverse=True)) + rf")(?!{_WORD})"
+)
+
+def intent_scores(text: str) -> Dict[str, int]:
+    """Distinct keyword hits per intent, from a single regex pass."""
+    scores: Dict[str, int] = {}
+    for kw in set(_MATCHER.findall(_norm(text))):
+        intent = _INTENT_OF[kw]
+        scores[intent] = scores.get(intent, 0) + 1
+    return scores
+
+def _pick(scores: Dict[str, int]) -> Optional[str]:
+    if scores:
+        # most hits; ties go to the intent listed first in KEYWORDS
+        return min(scores, key=lambda i: (-scores[i], _RANK[i]))
+    return None
 
+@lru_cache(maxsize=4096)
 def rule_intent(text: str) -> str:
-    t = text.lower()
-    for intent, words in KEYWORDS.items():
-        if any(re.search(rf"\b{re.escape(w)}\b", t) for w in words):
-            return intent
+    t = _norm(text)
+    intent = _pick(intent_scores(t))
+    if intent:
+        return intent
     # fallback heuristics
-    if "job" in t or "vacancy" in t:
+    if any(w in t for w in FALLBACK_JOB_WORDS):
         return "PrivateJobs"
     return "GeneralFAQ"
+
+# ---------- embedding classifier (optional) ----------
+class CentroidClassifier:
+    """
+    Nearest-centroid intent classifier over normalized sentence embeddings of
+    labelled examples. Used by classify_many for texts with no keyword hit.
+    """
+    def __init__(self, examples: Dict[str, List[str]] = EXAMPLES, min_sim: float = 0.35):
+        from services.embeddings import embed_texts  # loads the model only when used
+        import numpy as np
+        self.min_sim = min_sim
+        self.labels = list(examples)
+        cents = []
+        for label in self.labels:
+            c = embed_texts(examples[label]).mean(axis=0)
+            cents.append(c / (np.linalg.norm(c) or 1.0))
+        self.centroids = np.stack(cents).astype("float32")
+        self._embed = embed_texts
+
+    def predict(self, texts: List[str]) -> List[Optional[str]]:
+        """Best intent per text, or None below `min_sim` cosine similarity."""
+        if not texts:
+            return []
+        sims = self._embed(list(texts)) @ self.centroids.T
+        best = sims.argmax(axis=1)
+        return [self.labels[b] if sims[i, b] >= self.min_sim else None for i, b in enumerate(best)]
+
+_centroids = None
+
+def get_centroid_classifier() -> CentroidClassifier:
+    global _centroids
+    if _centroids is None:
+        _centroids = CentroidClassifier()
+    return _centroids
+
+def classify_many(texts: List[str], use_embeddings: bool = False) -> List[str]:
+    """
+    rule_intent for a batch. With use_embeddings, texts without any keyword
+    hit go to the centroid classifier in one embedding batch before the
+    job/vacancy fallback applies.
+    """
+    out = [None] * len(texts)
+    rest = []
+    for i, text in enumerate(texts):
+        intent = _pick(intent_scores(text))
+        if intent:
+            out[i] = intent
+        else:
+            rest.append(i)
+    if use_embeddings and rest:
+        for i, intent in zip(rest, get_centroid_classifier().predict([texts[i] for i in rest])):
+            out[i] = intent
+    for i in rest:
+        if out[i] is None:
+            out[i] = rule_intent(texts[i])
+    return out
+
+if __name__ == "__main__":
+    # throughput: legacy per-keyword re.search loop vs the precompiled matcher
+    def _legacy(text: str) -> str:
+        t = text.lower()
+        for intent, words in KEYWORDS.items():
+            if any(re.search(rf"\b{re.escape(w)}\b", t) for w in words):
+                return intent
+        if "job" in t or "vacancy" in t:
+            return "PrivateJobs"
+        return "GeneralFAQ"
+
+    samples = [s for ex in EXAMPLES.values() for s in ex] + [
+        "How do I register on the portal and reset my password?",
+        "Is there any job fair in Ludhiana next week?",
+        "Documents needed for the government clerk post",
+        "tell me something",
+    ]
+    n = 20_000
+    queries = [f"{samples[i % len(samples)]} #{i}" for i in range(n)]  # distinct, defeats the lru_cache
+
+    t0 = time.perf_counter()
+    for q in queries:
+        _legacy(q)
+    legacy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    classify_many(queries)
+    fast = time.perf_counter() - t0
+    print(f"legacy loop : {n / legacy:,.0f} texts/s")
+    print(f"single pass : {n / fast:,.0f} texts/s ({legacy / fast:.1f}x)")
+    for s in samples:
+        print(f"  {rule_intent(s):18} {_legacy(s):18} {s}")
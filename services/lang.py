@@ -0,0 +1,112 @@
+# services/lang.py
+import re
+import time
+from functools import lru_cache
+from langdetect import DetectorFactory, detect
+
+DetectorFactory.seed = 0  # langdetect is randomized; fix it so results are repeatable
+
+# share of letters that must be in an Indic script for it to win over Latin
+# (Gurmukhi/Devanagari messages often embed Latin names like "PGRKAM", "OTP")
+INDIC_MIN_SHARE = 0.25
+ROMANIZED_MIN_SHARE = 0.25  # share of words that must be romanized Hindi/Punjabi markers
+
+# frequent function words of romanized Punjabi / Hindi that are not English words
+ROMAN_PA = {"tusi", "tuhanu", "kidda", "kiddan", "kiven", "kive", "kithe", "vich", "nu", "hega", "haige",
+            "sanu", "mainu", "ohna", "karna", "kado", "kinne", "ki", "di", "da", "de", "ne", "te", "naal"}
+ROMAN_HI = {"hai", "hain", "kya", "kaise", "kaha", "kahan", "kab", "mujhe", "mera", "meri", "kaun",
+            "nahi", "nahin", "karna", "karo", "chahiye", "milegi", "milega", "ke", "ka", "ki", "ko", "se",
+            "aur", "liye", "bhi"}
+
+_WORDS = re.compile(r"[a-z]+")
+
+def script_counts(text: str):
+    """(gurmukhi, devanagari, latin) letter counts in one pass over the text."""
+    pa = hi = la = 0
+    for ch in text:
+        o = ord(ch)
+        if 0x0A00 <= o <= 0x0A7F:
+            pa += 1
+        elif 0x0900 <= o <= 0x097F:
+            hi += 1
+        elif ch.isalpha() and o < 0x0250:  # ASCII + Latin-1/Extended letters
+            la += 1
+    return pa, hi, la
+
+def _romanized(text: str):
+    words = _WORDS.findall(text.lower())
+    if not words:
+        return None
+    pa = sum(w in ROMAN_PA for w in words)
+    hi = sum(w in ROMAN_HI for w in words)
+    if max(pa, hi) < ROMANIZED_MIN_SHARE * len(words):
+        return None
+    return "pa" if pa > hi else "hi"
+
+@lru_cache(maxsize=8192)
+def _detect_normalized(text: str) -> str:
+    pa, hi, la = script_counts(text)
+    letters = pa + hi + la
+    if not letters:
+        return "en"
+    if pa + hi >= INDIC_MIN_SHARE * letters:
+        return "pa" if pa >= hi else "hi"
+    # Latin script: romanized Punjabi/Hindi markers first, then the statistical model
+    roman = _romanized(text)
+    if roman:
+        return roman
+    try:
+        return detect(text)
+    except Exception:
+        return "en"
+
+def detect_language(text: str) -> str:
+    """
+    Language code for a message: Gurmukhi → "pa", Devanagari → "hi" by
+    Unicode block; Latin text is checked for romanized Punjabi/Hindi and
+    otherwise handed to langdetect (seeded). Cached per normalized string.
+    """
+    return _detect_normalized(" ".join((text or "").split()))
+
+if __name__ == "__main__":
+    # latency / accuracy against plain langdetect on labelled samples
+    samples = [
+        ("ਮੈਂ ਨੌਕਰੀ ਲਈ ਰਜਿਸਟਰ ਕਿਵੇਂ ਕਰਾਂ?", "pa"),
+        ("ਰੋਜ਼ਗਾਰ ਮੇਲਾ ਕਦੋਂ ਹੈ", "pa"),
+        ("PGRKAM ਤੇ OTP ਨਹੀਂ ਆ ਰਿਹਾ", "pa"),
+        ("ਕਿਹੜੇ ਦਸਤਾਵੇਜ਼ ਚਾਹੀਦੇ ਹਨ", "pa"),
+        ("मैं नौकरी के लिए पंजीकरण कैसे करूं?", "hi"),
+        ("रोजगार मेला कब है", "hi"),
+        ("PGRKAM पर OTP नहीं आ रहा", "hi"),
+        ("कौन से दस्तावेज़ चाहिए", "hi"),
+        ("How do I register on the portal?", "en"),
+        ("When is the next job fair in Ludhiana?", "en"),
+        ("Which documents are required for the clerk post", "en"),
+        ("forgot password", "en"),
+        ("mujhe naukri kaise milegi", "hi"),
+        ("registration kaise karna hai", "hi"),
+        ("tusi mainu dasso job mela kado hai", "pa"),
+        ("naukri layi registration kiven karna", "pa"),
+    ]
+    n = 200
+    texts = [t for t, _ in samples]
+
+    def run(fn, label):
+        t0 = time.perf_counter()
+        for i in range(n):
+            for t in texts:
+                fn(f"{t} {i}")  # distinct strings: no cache hits
+        ms = (time.perf_counter() - t0) * 1000 / (n * len(texts))
+        acc = sum(fn(t) == y for t, y in samples) / len(samples)
+        print(f"{label:12} {ms:7.3f} ms/text  accuracy {acc:.0%}")
+
+    def _langdetect(t):
+        try:
+            return detect(t)
+        except Exception:
+            return "en"
+
+    run(_langdetect, "langdetect")
+    run(detect_language, "script+lex")
+    for t, y in samples:
+        print(f"  {y}  {detect_language(t):3} {_langdetect(t):3} {t}")
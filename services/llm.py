@@ -1,11 +1,16 @@
 # services/llm.py
 # services/llm.py  — REST version with clear error messages
-import os, requests
+import os, json
+from services import http_client
 
 MODEL_DEFAULT = os.getenv("MODEL_NAME", "llama-3.3-70b-versatile")
 API_URL = "https://api.groq.com/openai/v1/chat/completions"
 
-def chat_complete(system_prompt: str, user_prompt: str, temperature: float = 0.2, model: str = None):
+def _api_url() -> str:
+    # LLM_API_URL points at any OpenAI-compatible endpoint (e.g. tests/stub_server.py)
+    return os.environ.get("LLM_API_URL", API_URL)
+
+def _request_args(system_prompt: str, user_prompt: str, temperature: float, model: str, stream: bool) -> dict:
     api_key = os.environ.get("GROQ_API_KEY")
     if not api_key:
         raise RuntimeError("Missing GROQ_API_KEY in environment or secrets.")
@@ -18,13 +23,16 @@ def chat_complete(system_prompt: str, user_prompt: str, temperature: float = 0.2
             {"role": "user", "content": user_prompt}
         ],
     }
+    if stream:
+        payload["stream"] = True
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
-        "Accept": "application/json"
+        "Accept": "text/event-stream" if stream else "application/json"
     }
+    return {"json": payload, "headers": headers, "timeout": 60}
 
-    resp = requests.post(API_URL, json=payload, headers=headers, timeout=60)
+def _raise_for_error(resp):
     if resp.status_code >= 400:
         try:
             err = resp.json()
@@ -32,6 +40,35 @@ def chat_complete(system_prompt: str, user_prompt: str, temperature: float = 0.2
             err = {"error": {"message": resp.text}}
         # Surface the exact reason in the UI/logs
         raise RuntimeError(f"Groq API error {resp.status_code}: {err.get('error', {}).get('message', err)}")
+
+def chat_complete(system_prompt: str, user_prompt: str, temperature: float = 0.2, model: str = None):
+    # pooled keep-alive connection; 429/5xx are retried with backoff (services.http_client)
+    resp = http_client.request("POST", _api_url(), **_request_args(system_prompt, user_prompt, temperature, model, False))
+    _raise_for_error(resp)
     data = resp.json()
     return data["choices"][0]["message"]["content"]
 
+def chat_complete_stream(system_prompt: str, user_prompt: str, temperature: float = 0.2, model: str = None):
+    """
+    Same request as chat_complete with "stream": true; yields content deltas
+    as the server-sent events arrive (timeout applies per read, not in total).
+    """
+    kwargs = _request_args(system_prompt, user_prompt, temperature, model, True)
+    with http_client.stream("POST", _api_url(), **kwargs) as resp:
+        if resp.status_code >= 400:
+            resp.read()
+            _raise_for_error(resp)
+        # httpx decodes charset-less text/event-stream as UTF-8
+        for line in resp.iter_lines():
+            if not line or not line.startswith("data:"):
+                continue  # blank separators, ": keep-alive" comments
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if event.get("error"):
+                raise RuntimeError(f"Groq API error: {event['error'].get('message', event['error'])}")
+            for choice in event.get("choices", []):
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    yield delta
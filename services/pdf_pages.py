@@ -0,0 +1,29 @@
+# services/pdf_pages.py
+# Page-text extraction for the PDF worker pool in services.rag. Kept free of
+# faiss / sentence-transformers imports: spawned workers import only this module.
+from typing import List, Tuple
+from pypdf import PdfReader
+
+_reader = None  # this worker's reader, see init_worker
+
+def open_reader(path: str) -> PdfReader:
+    # a file object (not a path) makes pypdf seek and read lazily instead of
+    # loading the whole PDF into memory
+    return PdfReader(open(path, "rb"))
+
+def page_count(path: str) -> int:
+    reader = open_reader(path)
+    try:
+        return len(reader.pages)
+    finally:
+        reader.stream.close()
+
+def init_worker(path: str):
+    """Pool initializer: open the PDF once per worker process."""
+    global _reader
+    _reader = open_reader(path)
+
+def extract_pages(start: int, stop: int, reader: PdfReader = None) -> List[Tuple[int, str]]:
+    """Text of pages [start, stop) as (page_no, text), from `reader` or the worker's."""
+    reader = reader or _reader
+    return [(i + 1, (reader.pages[i].extract_text() or "").strip()) for i in range(start, stop)]
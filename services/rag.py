@@ -1,36 +1,641 @@
 # services/rag.py
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import uuid
 import faiss
 import numpy as np
-from typing import List, Dict, Any, Tuple
+from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple, Optional
 from pypdf import PdfReader
-from services.embeddings import embed_texts, embed_one
+from services.embeddings import embed_texts, model_name
+from services.bm25 import BM25Index, reciprocal_rank_fusion
+from services.dedup import NearDupFilter, DEDUP_THRESHOLD
+from services.answer_cache import get_answer_cache
+from services import pdf_pages
+
+INDEX_DIR = os.environ.get("INDEX_DIR", "data/index")
+_MANIFEST_VERSION = 2
+
+# "auto" | "flat" | "hnsw" | "ivf_flat" | "ivf_pq"
+INDEX_TYPE = os.environ.get("INDEX_TYPE", "auto")
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+TRAIN_SAMPLE = 50_000
+IVF_MIN_TRAIN = 1024  # an IVF store stays flat until it has this many vectors to train on
+# HNSW removals are tombstoned; the graph is rebuilt once this fraction of its nodes is dead
+HNSW_COMPACT_FRACTION = float(os.environ.get("HNSW_COMPACT_FRACTION", "0.2"))
+# fuse BM25 with dense hits in VectorStore.search (HYBRID_SEARCH=0 → dense only)
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "1") != "0"
+HYBRID_FETCH = 4  # candidates per retriever = HYBRID_FETCH * k
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+EMBED_BATCH = 64
+
+class StaleIndexError(RuntimeError):
+    """Saved index was built from different sources or another embedding model."""
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _meta_source(meta: Dict[str, Any]) -> str:
+    # pdf_to_chunks uses "source", ingest.jsonl_to_chunks uses "source_url"
+    return meta.get("source") or meta.get("source_url") or ""
+
+def _source_hashes(texts: List[str], metas: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Fallback manifest entry: one hash per source over its chunk texts."""
+    hashes: Dict[str, Any] = {}
+    for txt, meta in zip(texts, metas):
+        src = _meta_source(meta)
+        if src not in hashes:
+            hashes[src] = hashlib.sha256()
+        hashes[src].update(txt.encode("utf-8"))
+    return {src: h.hexdigest() for src, h in hashes.items()}
+
+# ---------- index factory ----------
+def choose_index_type(n: int) -> str:
+    """Exhaustive scan while it is cheap, graph/IVF beyond that, PQ for millions."""
+    if n < 10_000:
+        return "flat"
+    if n < 200_000:
+        return "hnsw"
+    if n < 2_000_000:
+        return "ivf_flat"
+    return "ivf_pq"
+
+def _nlist(n: int) -> int:
+    # ~4*sqrt(n) lists, but keep >= 39 training points per centroid
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+def _pq_m(dim: int) -> int:
+    return next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1) if dim % m == 0 and m <= dim)
+
+def make_index(embs: np.ndarray, index_type: str = "auto", ids: Optional[np.ndarray] = None,
+               train_size: int = TRAIN_SAMPLE, seed: int = 0):
+    """
+    Create, train (on a random sample of at most `train_size` rows) and fill a
+    FAISS inner-product index keyed by `ids` (default 0..n-1). Flat and HNSW
+    are wrapped in an IndexIDMap2. Returns (index, resolved_index_type).
+    """
+    n, dim = embs.shape
+    kind = choose_index_type(n) if index_type == "auto" else index_type
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}; expected auto or one of {INDEX_TYPES}")
+
+    if kind == "flat":
+        index = faiss.IndexFlatIP(dim)  # dot-product since normalized
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 80
+    elif kind == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, _nlist(n), faiss.METRIC_INNER_PRODUCT)
+    else:
+        # 8-bit codes need >= 256 training points per sub-quantizer
+        nbits = 8 if n >= 256 else max(1, int(np.log2(max(n, 2))))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatIP(dim), dim, _nlist(n), _pq_m(dim), nbits, faiss.METRIC_INNER_PRODUCT)
+
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = embs if n <= train_size else embs[rng.choice(n, train_size, replace=False)]
+        index.train(np.ascontiguousarray(sample))
+    if not kind.startswith("ivf"):
+        # IVF stores ids natively; IndexIDMap's remove_ids assumes flat-style renumbering
+        index = faiss.IndexIDMap2(index)
+    index.add_with_ids(embs, np.arange(n, dtype="int64") if ids is None else ids)
+    return index, kind
+
+def search_params(index_type: str, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  sel=None):
+    """
+    Per-call FAISS search parameters (thread-safe, unlike setting index attributes).
+    sel: optional faiss.IDSelector over chunk ids (HNSW only), see VectorStore._selector.
+    """
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe or DEFAULT_NPROBE))
+    if index_type == "hnsw":
+        if sel is not None:
+            return faiss.SearchParametersHNSW(efSearch=int(ef_search or DEFAULT_EF_SEARCH), sel=sel)
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or DEFAULT_EF_SEARCH))
+    return None
 
 class VectorStore:
-    def __init__(self):
-        self.index = None
-        self.chunks: List[str] = []
-        self.metas: List[Dict[str, Any]] = []
+    def __init__(self, index_type: str = INDEX_TYPE, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 hybrid: bool = HYBRID_SEARCH, dedup_threshold: float = DEDUP_THRESHOLD):
+        """
+        index_type: "auto" picks by corpus size (see choose_index_type).
+        nprobe / ef_search: default recall knobs for IVF / HNSW searches.
+        hybrid: fuse BM25 and dense rankings with reciprocal rank fusion.
+        dedup_threshold: MinHash Jaccard above which a new chunk is not embedded
+            but attached to the indexed chunk it duplicates (0 disables). It
+            stays in the BM25 index under its own key, so exact-token queries
+            still return its text and source.
+        """
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.hybrid = hybrid
+        self.lexical = BM25Index()  # built alongside the dense index from the same chunks
+        self.index = None  # id-keyed FAISS index, see make_index
+        self.chunks: Dict[int, str] = {}  # chunk id -> text
+        self.metas: Dict[int, Dict[str, Any]] = {}  # chunk id -> meta (incl. "chunk_id")
         self.dim = None
+        self.kind = None  # resolved index type of the built index
+        self.trained_on = 0  # vectors the current index was created from, see _maybe_rebuild
+        self.sources: Dict[str, str] = {}  # source -> content hash (manifest)
+        self.mmapped = False
+        self.path = None  # directory the index was loaded from / saved to
+        self._by_source: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self.dedup_threshold = dedup_threshold
+        self.near_dups: Optional[NearDupFilter] = None  # built lazily on first add
+        self.dupes: Dict[int, List[Tuple[int, str, Dict[str, Any]]]] = {}  # canonical id -> dropped (key, text, meta)
+        self._dupe_of: Dict[int, Tuple[int, str, Dict[str, Any]]] = {}  # BM25 key (< 0) -> (canonical id, text, meta)
+        self._dupe_key = 0
+        self._dupes_by_source: Dict[str, set] = {}  # source -> canonical ids holding its dropped chunks
+        self._tombstones: set = set()  # removed ids still in the HNSW graph, see remove_document
+        self._sel = None  # cached IDSelector excluding _tombstones
+        self.generation = uuid.uuid4().hex  # changes on build(); chunk ids restart there
 
-    def build(self, texts: List[str], metas: List[Dict[str, Any]]):
-        self.chunks = texts
-        self.metas = metas
-        embs = embed_texts(texts)
-        self.dim = embs.shape[1]
-        self.index = faiss.IndexFlatIP(self.dim)  # dot-product since normalized
-        self.index.add(embs)
+    def build(self, texts: List[str], metas: List[Dict[str, Any]], sources: Optional[Dict[str, str]] = None):
+        """
+        sources: optional {source: hash_bytes(raw file/page)}; recorded in the
+        manifest on save() so load() can refuse an index built from other content.
+        """
+        with self._lock:
+            cache = get_answer_cache()
+            if cache is not None:
+                cache.invalidate(self.generation)
+            self.generation = uuid.uuid4().hex
+            self.index, self.trained_on = None, 0
+            self.chunks, self.metas, self._by_source = {}, {}, {}
+            self.lexical = BM25Index()
+            self.near_dups, self.dupes, self._dupes_by_source, self._dupe_of = None, {}, {}, {}
+            self._dupe_key = 0
+            self._tombstones, self._sel = set(), None
+            self.sources = {}
+            self._next_id = 0
+            self.mmapped = False
+            self.add_documents(texts, metas, sources)
 
-    def search(self, query: str, k: int = 5) -> List[Tuple[str, Dict[str, Any], float]]:
-        if not self.index:
+    # ---------- incremental updates ----------
+    def add_documents(self, texts: List[str], metas: List[Dict[str, Any]],
+                      sources: Optional[Dict[str, str]] = None) -> List[int]:
+        """
+        Embed and index only `texts` (minus near-duplicates of indexed chunks,
+        which are listed under the canonical chunk's meta "also_in").
+        Returns the new chunk ids.
+        """
+        if not texts:
             return []
-        q = embed_one(query).reshape(1, -1)
-        scores, ids = self.index.search(q, k)
-        out = []
-        for score, idx in zip(scores[0], ids[0]):
-            if idx == -1:
+        ids = self._add(texts, metas)
+        with self._lock:
+            # only once indexed: a recorded hash tells callers the source is up to date
+            self.sources.update(sources if sources else _source_hashes(texts, metas))
+        return ids
+
+    def _add(self, texts: List[str], metas: List[Dict[str, Any]]) -> List[int]:
+        with self._lock:
+            keep, dropped, ids = self._dedup(texts)
+        if keep:
+            try:
+                embs = embed_texts([texts[i] for i in keep])
+            except Exception:
+                with self._lock:
+                    for cid in ids:
+                        if self.near_dups is not None:
+                            self.near_dups.remove(cid)
+                raise
+        with self._lock:
+            if keep:
+                id_arr = np.array(ids, dtype="int64")
+                if self.index is None:
+                    self.dim = embs.shape[1]
+                    self.index, self.kind = make_index(embs, self._target_kind(len(ids)), ids=id_arr)
+                    self.trained_on = len(ids)
+                else:
+                    self._ensure_writable()
+                    self.index.add_with_ids(embs, id_arr)
+                for cid, pos in zip(ids, keep):
+                    meta = metas[pos]
+                    self.chunks[cid] = texts[pos]
+                    self.metas[cid] = {**meta, "chunk_id": cid}
+                    self.lexical.add(cid, texts[pos])
+                    self._by_source.setdefault(_meta_source(meta), []).append(cid)
+                self._maybe_rebuild()
+            for pos, canon in dropped:
+                self._attach_dupe(canon, texts[pos], metas[pos])
+            return ids
+
+    def _target_kind(self, n: int) -> str:
+        kind = choose_index_type(n) if self.index_type == "auto" else self.index_type
+        if kind.startswith("ivf") and n < IVF_MIN_TRAIN:
+            return "flat"  # too few vectors to train the coarse quantizer yet
+        return kind
+
+    def _maybe_rebuild(self):
+        """
+        Re-create the index from its stored vectors when the corpus grew past a
+        choose_index_type threshold (or IVF_MIN_TRAIN), and retrain IVF indexes
+        whenever the corpus doubled while they were trained on fewer than
+        TRAIN_SAMPLE vectors. Batch-wise ingestion thus ends up with the index
+        a one-shot build() of the same corpus would produce (lock held).
+        """
+        n = len(self.chunks)
+        kind = self._target_kind(n)
+        retrain = kind.startswith("ivf") and 2 * self.trained_on <= min(n, TRAIN_SAMPLE)
+        if kind == self.kind and not retrain:
+            return
+        if self.kind == "ivf_pq":
+            # PQ codes decode lossily: retrain on the original embeddings (embedding cache hits)
+            ids = np.array(sorted(self.chunks), dtype="int64")
+            vecs = embed_texts([self.chunks[cid] for cid in ids.tolist()])
+        else:
+            ids, vecs = self._stored_vectors()
+        self.index, self.kind = make_index(vecs, kind, ids=ids)
+        self.trained_on = len(ids)
+        self._tombstones, self._sel = set(), None
+        self.mmapped = False
+
+    def _stored_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, vectors) of the live chunks in the FAISS index (PQ codes decode approximately)."""
+        if self.kind.startswith("ivf"):
+            ids = np.array(sorted(self.chunks), dtype="int64")
+            return ids, self.index.reconstruct_n(0, self._next_id)[ids]
+        ids = faiss.vector_to_array(self.index.id_map)
+        vecs = self.index.index.reconstruct_n(0, self.index.ntotal)
+        if self._tombstones:
+            live = np.array([i not in self._tombstones for i in ids.tolist()], dtype=bool)
+            ids, vecs = ids[live], vecs[live]
+        return ids, vecs
+
+    def _selector(self):
+        """IDSelector skipping tombstoned ids, or None if there are none (lock held)."""
+        if not self._tombstones:
+            return None
+        if self._sel is None:
+            batch = faiss.IDSelectorBatch(np.array(sorted(self._tombstones), dtype="int64"))
+            self._sel = (batch, faiss.IDSelectorNot(batch))  # keep `batch` alive alongside its wrapper
+        return self._sel[1]
+
+    def compact(self):
+        """
+        Rebuild the HNSW graph without its tombstoned nodes. The graph is built
+        outside the lock, so searches keep running on the old one meanwhile;
+        chunks added or removed during the build are carried over on swap.
+        """
+        with self._lock:
+            if self.kind != "hnsw" or not self._tombstones:
+                return
+            old = self.index
+            ids, vecs = self._stored_vectors()
+            dead = set(self._tombstones)
+        index, _ = make_index(vecs, "hnsw", ids=ids)
+        with self._lock:
+            if self.index is not old:
+                return  # rebuilt or reloaded meanwhile
+            built = set(ids.tolist())
+            added = [cid for cid in self.chunks if cid not in built]
+            if added:
+                index.add_with_ids(np.stack([old.reconstruct(cid) for cid in added]),
+                                   np.array(added, dtype="int64"))
+            self.index = index
+            self._tombstones = (self._tombstones - dead) & built
+            self._sel = None
+            self.mmapped = False
+
+    def vectors(self, ids: List[int]) -> Optional[np.ndarray]:
+        """
+        Normalized stored vectors of chunk ids, read back from the FAISS index
+        (a dropped duplicate's key gives its canonical chunk's vector). None if
+        an id is no longer indexed.
+        """
+        with self._lock:
+            ids = [self._dupe_of[i][0] if i in self._dupe_of else i for i in ids]
+            if self.index is None or any(i not in self.chunks for i in ids):
+                return None
+            if self.kind.startswith("ivf") and self.index.direct_map.type == faiss.DirectMap.NoMap:
+                self.index.set_direct_map_type(faiss.DirectMap.Hashtable)  # id -> list offset
+            vecs = np.stack([self.index.reconstruct(int(i)) for i in ids]).astype("float32")
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)  # PQ codes decode only approximately
+        return vecs / np.where(norms > 0, norms, 1.0)
+
+    def _dedup(self, texts: List[str]):
+        """Split positions into kept/dropped and reserve ids for the kept ones (lock held)."""
+        if self.dedup_threshold and self.near_dups is None:
+            self.near_dups = NearDupFilter(self.dedup_threshold)
+            for cid, txt in self.chunks.items():
+                _, exact, sig = self.near_dups.check(txt)
+                self.near_dups.add(cid, exact, sig)
+        keep, dropped = [], []
+        for pos, txt in enumerate(texts):
+            if self.near_dups is None:
+                keep.append(pos)
                 continue
-            out.append((self.chunks[idx], self.metas[idx], float(score)))
-        return out
+            canon, exact, sig = self.near_dups.check(txt)
+            if canon is None:
+                self.near_dups.add(self._next_id + len(keep), exact, sig)
+                keep.append(pos)
+            else:
+                dropped.append((pos, canon))
+        ids = list(range(self._next_id, self._next_id + len(keep)))
+        self._next_id += len(keep)
+        return keep, dropped, ids
+
+    def _attach_dupe(self, canon: int, text: str, meta: Dict[str, Any]):
+        if canon not in self.metas:
+            return
+        ref = {k: v for k, v in meta.items() if k not in ("chunk_id", "also_in", "duplicate_of")}
+        self._dupe_key -= 1
+        key = self._dupe_key
+        self._dupe_of[key] = (canon, text, ref)
+        self.lexical.add(key, text)
+        self.dupes.setdefault(canon, []).append((key, text, ref))
+        self.metas[canon]["also_in"] = [m for _, _, m in self.dupes[canon]]
+        self._dupes_by_source.setdefault(_meta_source(ref), set()).add(canon)
+
+    def _detach_dupe(self, key: int):
+        self._dupe_of.pop(key, None)
+        self.lexical.remove(key)
+
+    def _hit(self, doc_id: int, score: float) -> Tuple[str, Dict[str, Any], float]:
+        """Search result for a chunk id or a dropped duplicate's key (lock held)."""
+        if doc_id >= 0:
+            return self.chunks[doc_id], self.metas[doc_id], score
+        canon, text, meta = self._dupe_of[doc_id]
+        return text, {**meta, "chunk_id": doc_id, "duplicate_of": canon}, score
+
+    def remove_document(self, source: str) -> int:
+        """
+        Drop every chunk of `source` from the index and storage; returns the
+        count. Duplicates from other sources that pointed at a removed chunk
+        are re-indexed in its place.
+        """
+        with self._lock:
+            ids = self._by_source.pop(source, [])
+            self.sources.pop(source, None)
+            for canon in self._dupes_by_source.pop(source, set()):
+                rest = []
+                for key, t, m in self.dupes.get(canon, []):
+                    if _meta_source(m) == source:
+                        self._detach_dupe(key)
+                    else:
+                        rest.append((key, t, m))
+                if rest:
+                    self.dupes[canon] = rest
+                    self.metas[canon]["also_in"] = [m for _, _, m in rest]
+                else:
+                    self.dupes.pop(canon, None)
+                    if canon in self.metas:
+                        self.metas[canon].pop("also_in", None)
+            if not ids:
+                return 0
+            promote = []
+            for cid in ids:
+                for key, t, m in self.dupes.pop(cid, []):
+                    self._detach_dupe(key)
+                    promote.append((t, m))
+                    self._dupes_by_source.get(_meta_source(m), set()).discard(cid)
+                if self.near_dups is not None:
+                    self.near_dups.remove(cid)
+            if self.kind == "hnsw":
+                # HNSW graphs cannot delete nodes: searches skip tombstones until compact()
+                self._tombstones.update(ids)
+                self._sel = None
+            else:
+                self._ensure_writable()
+                self.index.remove_ids(np.array(ids, dtype="int64"))
+            for cid in ids:
+                del self.chunks[cid]
+                del self.metas[cid]
+                self.lexical.remove(cid)
+            if promote:
+                self._add([t for t, _ in promote], [m for _, m in promote])
+            need_compact = self.kind == "hnsw" and len(self._tombstones) > HNSW_COMPACT_FRACTION * self.index.ntotal
+        if need_compact:
+            self.compact()
+        return len(ids)
+
+    def replace_document(self, source: str, texts: List[str], metas: List[Dict[str, Any]],
+                         source_hash: Optional[str] = None) -> List[int]:
+        """
+        Swap in a new version of `source`. If `source_hash` matches the indexed
+        version nothing is embedded and [] is returned.
+        """
+        with self._lock:
+            if source_hash is not None and self.sources.get(source) == source_hash:
+                return []
+        self.remove_document(source)
+        return self.add_documents(texts, metas, {source: source_hash} if source_hash else None)
+
+    def _ensure_writable(self):
+        # memory-mapped indexes are read-only; mutate a private in-memory copy
+        if self.mmapped:
+            self.index = faiss.read_index(os.path.join(self.path, "index.faiss"))
+            self.mmapped = False
+
+    # ---------- persistence ----------
+    def save(self, path: str = INDEX_DIR) -> str:
+        """
+        Layout of `path`:
+          index.faiss    native FAISS index (memory-mappable)
+          chunks.jsonl   one {"id", "text", "meta"} record per vector
+          dupes.jsonl    {"canonical", "text", "meta"} per deduplicated chunk
+          manifest.json  model name, dim, count, source hashes (written last)
+        """
+        if self.index is None:
+            raise RuntimeError("Nothing to save: build the index first.")
+        out = Path(path)
+        out.mkdir(parents=True, exist_ok=True)
+
+        with self._lock:
+            tmp = out / "index.faiss.tmp"
+            faiss.write_index(self.index, str(tmp))
+            os.replace(tmp, out / "index.faiss")
+
+            tmp = out / "chunks.jsonl.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for cid, txt in self.chunks.items():
+                    f.write(json.dumps({"id": cid, "text": txt, "meta": self.metas[cid]}, ensure_ascii=False) + "\n")
+            os.replace(tmp, out / "chunks.jsonl")
+
+            tmp = out / "dupes.jsonl.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for canon, items in self.dupes.items():
+                    for _, txt, meta in items:
+                        f.write(json.dumps({"canonical": canon, "text": txt, "meta": meta}, ensure_ascii=False) + "\n")
+            os.replace(tmp, out / "dupes.jsonl")
+
+            manifest = {
+                "version": _MANIFEST_VERSION,
+                "model": model_name(),
+                "dim": self.dim,
+                "count": int(self.index.ntotal),
+                "index_type": self.kind,
+                "requested_index_type": self.index_type,
+                "trained_on": self.trained_on,
+                "next_id": self._next_id,
+                "tombstones": sorted(self._tombstones),
+                "sources": self.sources,
+                "created_at": int(time.time()),
+            }
+            tmp = out / "manifest.json.tmp"
+            tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, out / "manifest.json")
+            if not self.mmapped:
+                self.path = str(out)
+        return str(out)
+
+    @classmethod
+    def load(cls, path: str = INDEX_DIR, mmap: bool = True, sources: Optional[Dict[str, str]] = None) -> "VectorStore":
+        """
+        Load an index written by save(). With mmap=True the FAISS data is mapped
+        read-only, so every Streamlit worker process shares the same page cache
+        (the first add/remove copies it into memory).
+        Raises FileNotFoundError if nothing was saved and StaleIndexError if the
+        embedding model changed or `sources` differs from the manifest.
+        """
+        src = Path(path)
+        manifest_path = src / "manifest.json"
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"No saved index at {src}")
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+
+        if manifest.get("version") != _MANIFEST_VERSION:
+            raise StaleIndexError(f"Unsupported index format version {manifest.get('version')}")
+        if manifest.get("model") != model_name():
+            raise StaleIndexError(f"Index built with {manifest.get('model')}, current model is {model_name()}")
+        if sources is not None and manifest.get("sources") != sources:
+            raise StaleIndexError("Index sources changed since it was built; rebuild required.")
+
+        kind = manifest.get("index_type") or "flat"
+        flags = 0
+        if mmap:
+            # IVF lists map through OnDiskInvertedLists; flat codes (flat/HNSW storage) map zero-copy
+            flags = faiss.IO_FLAG_MMAP if kind.startswith("ivf") else faiss.IO_FLAG_MMAP_IFC
+        index = faiss.read_index(str(src / "index.faiss"), flags)
+
+        vs = cls(index_type=manifest.get("requested_index_type") or kind)
+        with open(src / "chunks.jsonl", "r", encoding="utf-8") as f:
+            for line in f:
+                obj = json.loads(line)
+                cid = int(obj["id"])
+                vs.chunks[cid] = obj["text"]
+                vs.metas[cid] = obj["meta"]
+                vs.lexical.add(cid, obj["text"])
+                vs._by_source.setdefault(_meta_source(obj["meta"]), []).append(cid)
+        vs._tombstones = set(manifest.get("tombstones", []))
+        if index.ntotal != manifest.get("count") or len(vs.chunks) + len(vs._tombstones) != index.ntotal:
+            raise StaleIndexError("Index and chunk files are out of sync (interrupted save?).")
+        if (src / "dupes.jsonl").exists():
+            with open(src / "dupes.jsonl", "r", encoding="utf-8") as f:
+                for line in f:
+                    obj = json.loads(line)
+                    vs._attach_dupe(int(obj["canonical"]), obj["text"], obj["meta"])
+
+        vs.kind = kind
+        vs.trained_on = int(manifest.get("trained_on", index.ntotal))
+        vs.index = index
+        vs.dim = manifest["dim"]
+        vs.sources = manifest.get("sources", {})
+        vs._next_id = int(manifest.get("next_id", max(vs.chunks, default=-1) + 1))
+        vs.mmapped = mmap
+        vs.path = str(src)
+        return vs
+
+    def search(self, query: str, k: int = 5, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, hybrid: Optional[bool] = None,
+               query_vec: Optional[np.ndarray] = None) -> List[Tuple[str, Dict[str, Any], float]]:
+        """
+        Top-k (text, meta, score). In hybrid mode dense and BM25 candidates are
+        fused by reciprocal rank and `score` is the fused RRF score; otherwise
+        it is the inner product. `query_vec`: the query's embedding, if the
+        caller already has it.
+        """
+        return self.search_many([query], k, nprobe=nprobe, ef_search=ef_search, hybrid=hybrid,
+                                query_vecs=None if query_vec is None else query_vec[None, :])[0]
+
+    def search_many(self, queries: List[str], k: int = 5, nprobe: Optional[int] = None,
+                    ef_search: Optional[int] = None, hybrid: Optional[bool] = None,
+                    query_vecs: Optional[np.ndarray] = None) -> List[List[Tuple[str, Dict[str, Any], float]]]:
+        """Batched search(): one embedding batch and one FAISS call for all queries."""
+        if not self.index or not queries:
+            return [[] for _ in queries]
+        hybrid = self.hybrid if hybrid is None else hybrid
+        fetch = k * HYBRID_FETCH if hybrid else k
+        q = embed_texts(list(queries)) if query_vecs is None else np.ascontiguousarray(query_vecs, dtype="float32")
+        results = []
+        with self._lock:
+            params = search_params(self.kind, nprobe or self.nprobe, ef_search or self.ef_search, self._selector())
+            scores, ids = self.index.search(q, fetch, params=params)
+            for query, row_scores, row_ids in zip(queries, scores, ids):
+                dense = [(int(idx), float(score)) for score, idx in zip(row_scores, row_ids) if idx != -1]
+                if hybrid:
+                    lexical = [doc_id for doc_id, _ in self.lexical.search(query, fetch)]
+                    ranked = reciprocal_rank_fusion([[i for i, _ in dense], lexical])[:k]
+                else:
+                    ranked = dense
+                results.append([self._hit(i, score) for i, score in ranked])
+        return results
+
+def recall_report(vs: VectorStore, queries: List[str], k: int = 10,
+                  nprobes=(1, 4, 16, 64), ef_searches=(16, 32, 64, 128)) -> List[Dict[str, Any]]:
+    """
+    recall@k and mean latency of `vs` for each nprobe/efSearch setting,
+    measured against an exact flat index over the same chunks.
+    """
+    if not vs.index or not queries:
+        return []
+    q = embed_texts(queries)
+    flat = faiss.IndexFlatIP(vs.dim)
+    flat.add(embed_texts(list(vs.chunks.values())))  # served from the embedding cache
+    _, pos = flat.search(q, k)
+    chunk_ids = np.array(list(vs.chunks), dtype="int64")
+    truth = np.where(pos >= 0, chunk_ids[pos], -1)
+
+    if vs.kind in ("ivf_flat", "ivf_pq"):
+        settings = [{"nprobe": v} for v in nprobes]
+    elif vs.kind == "hnsw":
+        settings = [{"ef_search": v} for v in ef_searches]
+    else:
+        settings = [{}]
+
+    report = []
+    for setting in settings:
+        with vs._lock:
+            params = search_params(vs.kind, setting.get("nprobe"), setting.get("ef_search"), vs._selector())
+        t0 = time.perf_counter()
+        _, found = vs.index.search(q, k, params=params)
+        elapsed = time.perf_counter() - t0
+        recall = np.mean([len(set(f[f >= 0]) & set(t[t >= 0])) / max(1, len(t[t >= 0]))
+                          for f, t in zip(found, truth)])
+        report.append({
+            "index_type": vs.kind, **setting, "k": k,
+            f"recall@{k}": float(recall),
+            "ms_per_query": 1000 * elapsed / len(queries),
+        })
+    return report
+
+def _split_text(text: str, max_chars: int, overlap: int) -> List[str]:
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(start + max_chars, len(text))
+        pieces.append(text[start:end])
+        start = end - overlap
+        if start < 0:
+            start = 0
+        if end >= len(text):
+            break
+    return pieces
 
 def pdf_to_chunks(file, max_chars: int = 900, overlap: int = 150):
     reader = PdfReader(file)
@@ -40,30 +645,238 @@ def pdf_to_chunks(file, max_chars: int = 900, overlap: int = 150):
         text = (page.extract_text() or "").strip()
         if not text:
             continue
-        start = 0
-        while start < len(text):
-            end = min(start + max_chars, len(text))
-            chunk = text[start:end]
+        for chunk in _split_text(text, max_chars, overlap):
             chunks.append(chunk)
             metas.append({"source": doc_name, "page": i + 1})
-            start = end - overlap
-            if start < 0:
-                start = 0
-            if end >= len(text):
-                break
     return chunks, metas
 
+# ---------- streaming PDF ingestion ----------
+def _doc_name(file) -> str:
+    return getattr(file, "name", None) or (Path(file).name if isinstance(file, (str, Path)) else "document.pdf")
+
+@contextmanager
+def _pdf_path(file):
+    """Path of `file` on disk; bytes and uploads are spooled once to a temp file."""
+    if isinstance(file, (str, Path)):
+        yield str(file)
+        return
+    fd, tmp = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            if isinstance(file, (bytes, bytearray)):
+                out.write(file)
+            else:
+                file.seek(0)
+                shutil.copyfileobj(file, out)
+        yield tmp
+    finally:
+        os.remove(tmp)
+
+def _hash_file(path: str) -> str:
+    h = hashlib.sha256()  # same digest as hash_bytes over the whole file
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def iter_pdf_chunks(file, max_chars: int = 900, overlap: int = 150, workers: Optional[int] = None,
+                    pages_per_task: int = 8, doc_name: Optional[str] = None):
+    """
+    Generator version of pdf_to_chunks: yields (chunk, meta) in page order
+    while page ranges are extracted in a process pool. The PDF is written to
+    disk once and every worker opens it once (services.pdf_pages), so tasks
+    carry only page numbers; at most 2*workers ranges are in flight.
+    """
+    doc_name = doc_name or _doc_name(file)
+    workers = workers or PDF_WORKERS
+
+    def emit(page_texts):
+        for page_no, text in page_texts:
+            if text:
+                for chunk in _split_text(text, max_chars, overlap):
+                    yield chunk, {"source": doc_name, "page": page_no}
+
+    with _pdf_path(file) as path:
+        n_pages = pdf_pages.page_count(path)
+        ranges = [(s, min(s + pages_per_task, n_pages)) for s in range(0, n_pages, pages_per_task)]
+        if workers <= 1 or len(ranges) <= 1:
+            reader = pdf_pages.open_reader(path)
+            try:
+                for start, stop in ranges:
+                    yield from emit(pdf_pages.extract_pages(start, stop, reader))
+            finally:
+                reader.stream.close()
+            return
+
+        # spawn, not fork: forking the threaded Streamlit server can copy held locks
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=pdf_pages.init_worker, initargs=(path,)) as pool:
+            pending = deque()
+            todo = iter(ranges)
+            for start, stop in todo:
+                pending.append(pool.submit(pdf_pages.extract_pages, start, stop))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                page_texts = pending.popleft().result()
+                nxt = next(todo, None)
+                if nxt is not None:
+                    pending.append(pool.submit(pdf_pages.extract_pages, *nxt))
+                yield from emit(page_texts)
+
+def index_pdf(vs: VectorStore, file, batch_size: int = EMBED_BATCH, source_hash: Optional[str] = None,
+              **chunk_kwargs) -> int:
+    """
+    Replace the document in `vs` by streaming its chunks in `batch_size`
+    batches through embedding and index insertion. Returns chunks indexed.
+    The source hash is recorded only after the last batch; if a batch fails
+    the partially indexed document is removed again.
+    """
+    doc_name = _doc_name(file)
+    with _pdf_path(file) as path:
+        digest = source_hash or _hash_file(path)
+        vs.remove_document(doc_name)
+        texts, metas, total = [], [], 0
+        try:
+            for chunk, meta in iter_pdf_chunks(path, doc_name=doc_name, **chunk_kwargs):
+                texts.append(chunk)
+                metas.append(meta)
+                if len(texts) >= batch_size:
+                    total += len(vs._add(texts, metas))
+                    texts, metas = [], []
+            if texts:
+                total += len(vs._add(texts, metas))
+        except BaseException:
+            vs.remove_document(doc_name)
+            raise
+    with vs._lock:
+        vs.sources[doc_name] = digest
+    return total
+
 # in services/rag.py
-def build_context(snippets, lang_hint: str = "en") -> str:
-    lines = []
+# ---------- context assembly ----------
+CONTEXT_TOKENS = int(os.environ.get("CONTEXT_TOKENS", "1500"))  # prompt budget for retrieved context
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.7"))  # 1 = pure relevance, 0 = pure diversity
+MIN_OVERLAP = 40  # chars; chunkers overlap by 150-200
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count: ~4 chars per token for ASCII, ~2 for Indic scripts."""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return -(-(ascii_chars * 2 + (len(text) - ascii_chars) * 4) // 8)
+
+def _cite_label(meta: Dict[str, Any]) -> str:
+    src = _meta_source(meta) or "N/A"
+    if src.startswith("http"):
+        return src
+    return f"{src} p.{meta.get('page','?')}"
+
+def _cite_labels(meta: Dict[str, Any], limit: int = 3) -> List[str]:
+    """The hit's own label plus those of duplicates dropped in its favour ("also_in")."""
+    labels = [_cite_label(meta)] + [_cite_label(m) for m in meta.get("also_in", [])]
+    return list(dict.fromkeys(labels))[:limit]
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is a prefix of `b` (0 if < MIN_OVERLAP)."""
+    head = b[:MIN_OVERLAP]
+    if len(head) < MIN_OVERLAP:
+        return 0
+    pos = a.find(head, max(0, len(a) - len(b)))
+    while pos != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(head, pos + 1)
+    return 0
+
+def _merge_overlaps(snippets) -> List[List[Any]]:
+    """
+    Join chunks of the same source/page whose ends overlap; keeps first-seen
+    order. Items are [label, text, citation labels].
+    """
+    out = []
     for txt, meta, score in snippets:
-        src = meta.get("source", "N/A")
-        if src.startswith("http"):
-            lines.append(f"[{src}] {txt}")
+        label = _cite_label(meta)
+        labels = _cite_labels(meta)
+        for item in out:
+            if item[0] != label:
+                continue
+            cur = item[1]
+            if cur in txt:
+                item[1] = txt
+            elif txt not in cur:
+                k = _overlap(cur, txt)
+                if k:
+                    item[1] = cur + txt[k:]
+                else:
+                    k = _overlap(txt, cur)
+                    if not k:
+                        continue
+                    item[1] = txt + cur[k:]
+            item[2] = list(dict.fromkeys(item[2] + labels))
+            break
         else:
-            pg = meta.get("page","?")
-            lines.append(f"[{src} p.{pg}] {txt}")
-    return "\n\n".join(lines)
+            out.append([label, txt, labels])
+    return out
+
+def _mmr_order(query: str, texts: List[str], lambda_: float, query_vec: Optional[np.ndarray] = None,
+               vectors: Optional[np.ndarray] = None) -> List[int]:
+    """
+    Maximal marginal relevance ranking of `texts` for `query`. Embeddings
+    not passed in (query_vec, vectors aligned with texts) are computed.
+    """
+    if query_vec is None:
+        query_vec = embed_texts([query])[0]
+    if vectors is None:
+        vectors = embed_texts(texts)
+    rel = vectors @ query_vec
+    sim = vectors @ vectors.T
+    order, left = [], list(range(len(texts)))
+    while left:
+        if order:
+            red = sim[np.ix_(left, order)].max(axis=1)
+        else:
+            red = np.zeros(len(left), dtype="float32")
+        best = int(np.argmax(lambda_ * rel[left] - (1 - lambda_) * red))
+        order.append(left.pop(best))
+    return order
+
+def build_context(snippets, lang_hint: str = "en", query: Optional[str] = None,
+                  token_budget: Optional[int] = CONTEXT_TOKENS, mmr_lambda: float = MMR_LAMBDA,
+                  stats: Optional[Dict[str, Any]] = None, query_vec: Optional[np.ndarray] = None,
+                  vectors: Optional[np.ndarray] = None) -> str:
+    """
+    Format (text, meta, score) hits as "[source] text" blocks. With `query`
+    the hits are reordered by MMR (on `query_vec` / hit `vectors` when
+    given, e.g. from VectorStore.vectors, else embedded here); overlapping chunks of one source/page are
+    merged, and blocks are packed into `token_budget` estimated tokens
+    (None = no limit). If `stats` is given it receives tokens_in (naive
+    concatenation), tokens_out, tokens_saved, snippets_in and snippets_out.
+    """
+    snippets = list(snippets)
+    if query and len(snippets) > 1:
+        order = _mmr_order(query, [t for t, _, _ in snippets], mmr_lambda, query_vec, vectors)
+        snippets = [snippets[i] for i in order]
+    blocks = [f"[{'; '.join(labels)}] {txt}" for _, txt, labels in _merge_overlaps(snippets)]
+
+    lines, used = [], 0
+    for block in blocks:
+        cost = estimate_tokens(block) + 1  # + separator
+        if token_budget is None or used + cost <= token_budget:
+            lines.append(block)
+            used += cost
+        elif not lines:
+            # a single oversized block: keep its head rather than nothing
+            keep = int(len(block) * token_budget / cost)
+            lines.append(block[:keep])
+            used = estimate_tokens(lines[0])
+    context = "\n\n".join(lines)
+
+    if stats is not None:
+        tokens_in = estimate_tokens("\n\n".join(f"[{_cite_label(m)}] {t}" for t, m, _ in snippets))
+        tokens_out = estimate_tokens(context)
+        stats.update({"tokens_in": tokens_in, "tokens_out": tokens_out,
+                      "tokens_saved": max(0, tokens_in - tokens_out),
+                      "snippets_in": len(snippets), "snippets_out": len(lines)})
+    return context
 
 SYSTEM_PROMPT = """You are PGRKAM Ai Assistant. RULES:
 -Answer ONLY with verified PGRKAM context.
@@ -71,23 +884,81 @@ SYSTEM_PROMPT = """You are PGRKAM Ai Assistant. RULES:
 - If no retrieved context is provided, refuse and direct to https://www.pgrkam.com."
 """
 
-def rag_answer(vs: VectorStore, query: str, lang_hint: str, llm_fn, top_k: int = 5) -> str:
-    hits = vs.search(query, k=top_k)
-    if not hits:
-        return "माफ़ कीजिए, इस विषय की जानकारी अभी संदर्भ में नहीं मिली। कृपया बाएँ साइडबार से PGRKAM की PDF/पेज जोड़ें और 'Build/Update Index' दबाएँ।"
+NO_CONTEXT_MSG = "माफ़ कीजिए, इस विषय की जानकारी अभी संदर्भ में नहीं मिली। कृपया बाएँ साइडबार से PGRKAM की PDF/पेज जोड़ें और 'Build/Update Index' दबाएँ।"
 
-    context = build_context(hits, lang_hint)
+def _prompt_from_hits(query: str, lang_hint: str, hits, stats: Optional[Dict[str, Any]] = None,
+                      query_vec: Optional[np.ndarray] = None, vectors: Optional[np.ndarray] = None) -> str:
+    context = build_context(hits, lang_hint, query=query, stats=stats, query_vec=query_vec, vectors=vectors)
     cites = []
     for _, meta, _ in hits[:3]:
-        s = meta.get("source","")
-        cites.append(f"({s if s.startswith('http') else f'{s} p.{meta.get('page','?')}'})")
+        cites.extend(f"({label})" for label in _cite_labels(meta))
     cites = " ".join(dict.fromkeys(cites))
 
-    user_prompt = (
+    return (
         f"User language: {lang_hint}\n"
         f"Question: {query}\n\n"
         f"Context (must use):\n{context}\n\n"
         f"Instructions:\n- Use ONLY the context above.\n- Include citations like {cites}."
     )
-    return llm_fn(SYSTEM_PROMPT, user_prompt)
 
+def _retrieve(vs: VectorStore, query: str, top_k: int):
+    """(query embedding, hits): the query is encoded once for search, cache and MMR."""
+    query_vec = embed_texts([query])[0]
+    return query_vec, vs.search(query, k=top_k, query_vec=query_vec)
+
+def _hit_vectors(vs: VectorStore, hits) -> Optional[np.ndarray]:
+    return vs.vectors([m["chunk_id"] for _, m, _ in hits]) if len(hits) > 1 else None
+
+def _cache_lookup(vs: VectorStore, query_vec: np.ndarray, lang_hint: str, hits, use_cache: bool):
+    """(cached answer or None, key args for AnswerCache.put or None)."""
+    cache = get_answer_cache() if use_cache else None
+    if cache is None:
+        return None, None
+    key = (query_vec, vs.generation, lang_hint, [m["chunk_id"] for _, m, _ in hits])
+    return cache.get(*key), key
+
+def rag_answer(vs: VectorStore, query: str, lang_hint: str, llm_fn, top_k: int = 5, use_cache: bool = True,
+               stats: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Answers for paraphrases of an earlier question that retrieved the same
+    chunks are served from the semantic answer cache (services.answer_cache).
+    `stats` (a dict) receives "cached" and build_context's token report.
+    """
+    query_vec, hits = _retrieve(vs, query, top_k)
+    if not hits:
+        return NO_CONTEXT_MSG
+    cached, key = _cache_lookup(vs, query_vec, lang_hint, hits, use_cache)
+    if stats is not None:
+        stats["cached"] = cached is not None
+    if cached is not None:
+        return cached
+    prompt = _prompt_from_hits(query, lang_hint, hits, stats, query_vec, _hit_vectors(vs, hits))
+    answer = llm_fn(SYSTEM_PROMPT, prompt)
+    if key is not None:
+        get_answer_cache().put(*key, answer)
+    return answer
+
+def rag_answer_stream(vs: VectorStore, query: str, lang_hint: str, stream_fn, top_k: int = 5,
+                      use_cache: bool = True, stats: Optional[Dict[str, Any]] = None):
+    """
+    rag_answer for streaming LLM functions (e.g. chat_complete_stream): yields
+    text pieces. A cached answer is yielded whole; a streamed one is cached
+    only if the stream completes. `stats` is filled as in rag_answer.
+    """
+    query_vec, hits = _retrieve(vs, query, top_k)
+    if not hits:
+        yield NO_CONTEXT_MSG
+        return
+    cached, key = _cache_lookup(vs, query_vec, lang_hint, hits, use_cache)
+    if stats is not None:
+        stats["cached"] = cached is not None
+    if cached is not None:
+        yield cached
+        return
+    prompt = _prompt_from_hits(query, lang_hint, hits, stats, query_vec, _hit_vectors(vs, hits))
+    parts = []
+    for piece in stream_fn(SYSTEM_PROMPT, prompt):
+        parts.append(piece)
+        yield piece
+    if key is not None:
+        get_answer_cache().put(*key, "".join(parts))
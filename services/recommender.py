@@ -1,8 +1,14 @@
 # services/recommender.py
+import os
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
-from typing import Dict, List
-from services.embeddings import embed_texts, embed_one
+from pathlib import Path
+from typing import Dict, List, Optional
+from services.embeddings import embed_texts, embed_one, model_name
+
+JOB_CACHE_DIR = os.environ.get("JOB_CACHE_DIR", "data/index/jobs")
 
 def load_jobs_csv(path: str) -> pd.DataFrame:
     df = pd.read_csv(path)
@@ -12,24 +18,105 @@ def load_jobs_csv(path: str) -> pd.DataFrame:
             df[col] = ""
     return df
 
-def make_recs(df: pd.DataFrame, prefs: Dict, top_k: int = 5) -> pd.DataFrame:
-    # Build text blobs
-    job_texts = (df["title"].fillna("") + " | " +
-                 df["sector"].fillna("") + " | " +
-                 df["location"].fillna("") + " | " +
-                 df["description"].fillna("")).tolist()
-    job_vecs = embed_texts(job_texts)
+def _job_texts(df: pd.DataFrame) -> List[str]:
+    return (df["title"].fillna("").astype(str) + " | " +
+            df["sector"].fillna("").astype(str) + " | " +
+            df["location"].fillna("").astype(str) + " | " +
+            df["description"].fillna("").astype(str)).tolist()
 
-    pref_str = " ".join([
+def _pref_text(prefs: Dict) -> str:
+    return " ".join([
         "role:" + ",".join(prefs.get("roles", [])),
         "sector:" + ",".join(prefs.get("sectors", [])),
         "location:" + ",".join(prefs.get("locations", [])),
         "degree:" + prefs.get("degree",""),
         "exp:" + str(prefs.get("experience",""))
     ])
-    q = embed_one(pref_str).reshape(1,-1)
-    sims = (job_vecs @ q.T).ravel()
-    top_idx = np.argsort(-sims)[:top_k]
+
+def _top_k(df: pd.DataFrame, sims: np.ndarray, top_k: int) -> pd.DataFrame:
+    k = min(top_k, len(sims))
+    if k <= 0:
+        out = df.iloc[:0].copy()
+        out["score"] = []
+        return out
+    top_idx = np.argpartition(-sims, k - 1)[:k]
+    top_idx = top_idx[np.argsort(-sims[top_idx])]
     out = df.iloc[top_idx].copy()
     out["score"] = sims[top_idx]
-    return out.sort_values("score", ascending=False)
+    return out
+
+def make_recs(df: pd.DataFrame, prefs: Dict, top_k: int = 5, job_vecs: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Pass `job_vecs` (e.g. JobIndex.vecs) to skip embedding the whole CSV."""
+    if job_vecs is None:
+        job_vecs = embed_texts(_job_texts(df))
+    q = embed_one(_pref_text(prefs))
+    sims = np.asarray(job_vecs @ q).ravel()
+    return _top_k(df, sims, top_k)
+
+# ---------- precomputed job index ----------
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class JobIndex:
+    """
+    Jobs DataFrame plus its normalized embedding matrix, built once per CSV
+    version. A recommendation is one preference embedding, a mat-vec product
+    and an argpartition top-k.
+    """
+    def __init__(self, df: pd.DataFrame, vecs: np.ndarray, digest: str, mtime_ns: int):
+        self.df = df
+        self.vecs = vecs
+        self.digest = digest
+        self.mtime_ns = mtime_ns
+
+    @classmethod
+    def from_csv(cls, path: str, cache_dir: Optional[str] = JOB_CACHE_DIR) -> "JobIndex":
+        """cache_dir=None keeps the matrix in memory only."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        digest = _file_sha256(path)
+        df = load_jobs_csv(path)
+
+        vecs = None
+        npy = None
+        if cache_dir:
+            slug = hashlib.sha256(model_name().encode("utf-8")).hexdigest()[:8]
+            npy = Path(cache_dir) / f"jobs-{digest[:16]}-{slug}.npy"
+            if npy.exists():
+                vecs = np.load(npy, mmap_mode="r")
+                if vecs.shape[0] != len(df):
+                    vecs = None
+        if vecs is None:
+            vecs = embed_texts(_job_texts(df))
+            if npy is not None:
+                npy.parent.mkdir(parents=True, exist_ok=True)
+                tmp = npy.with_name(npy.name + ".tmp.npy")
+                np.save(tmp, vecs)
+                os.replace(tmp, npy)
+        return cls(df, vecs, digest, mtime_ns)
+
+    def recommend(self, prefs: Dict, top_k: int = 5) -> pd.DataFrame:
+        return make_recs(self.df, prefs, top_k=top_k, job_vecs=self.vecs)
+
+_job_indexes: Dict[str, JobIndex] = {}
+_job_lock = threading.Lock()
+
+def get_job_index(path: str, cache_dir: Optional[str] = JOB_CACHE_DIR) -> JobIndex:
+    """
+    Process-wide JobIndex for `path`. Rebuilt only when the file content
+    changes; an mtime bump with identical content just refreshes the stamp.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _job_lock:
+        idx = _job_indexes.get(path)
+        if idx is not None and idx.mtime_ns == mtime_ns:
+            return idx
+        if idx is not None and idx.digest == _file_sha256(path):
+            idx.mtime_ns = mtime_ns
+            return idx
+        idx = JobIndex.from_csv(path, cache_dir=cache_dir)
+        _job_indexes[path] = idx
+        return idx
@@ -1,26 +1,241 @@
 # services/voice.py
 import io
 import os
-import tempfile
-from typing import Optional
+import re
+import json
+import wave
+import shutil
+import time
+import hashlib
+import threading
+import subprocess
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
-from gtts import gTTS
+# -----------------------
+# Text-to-Speech backends
+# -----------------------
+# TTS_BACKEND=espeak / silent gives offline speech (silent: placeholder WAV, for tests)
+TTS_BACKEND = os.environ.get("TTS_BACKEND", "gtts")
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "data/tts_cache")
+TTS_CACHE_MB = float(os.environ.get("TTS_CACHE_MB", "200"))  # 0 disables the audio cache
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "4"))  # concurrent sentence syntheses
+
+def _tts_lang(lang_hint: str) -> str:
+    lang_map = {"en": "en", "hi": "hi", "pa": "pa"}
+    return lang_map.get((lang_hint or "en").lower(), "en")
+
+def _gtts_backend(text: str, lang: str, slow: bool) -> bytes:
+    from gtts import gTTS  # imported on use so offline backends work without it
+    mp3_buf = io.BytesIO()
+    tts = gTTS(text=text, lang=lang, slow=slow)
+    tts.write_to_fp(mp3_buf)
+    return mp3_buf.getvalue()
+
+def _espeak_backend(text: str, lang: str, slow: bool) -> bytes:
+    exe = shutil.which("espeak-ng") or shutil.which("espeak")
+    if not exe:
+        raise RuntimeError("espeak-ng is not installed (TTS_BACKEND=espeak).")
+    speed = ["-s", "120"] if slow else []
+    return subprocess.run([exe, "--stdout", "-v", lang, *speed, text],
+                          check=True, capture_output=True, timeout=60).stdout
+
+def _silent_backend(text: str, lang: str, slow: bool) -> bytes:
+    # 16 kHz mono silence, ~60 ms per character (capped at 30 s)
+    frames = int(16000 * min(30.0, 0.06 * len(text) * (1.5 if slow else 1.0)))
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\x00\x00" * frames)
+    return buf.getvalue()
+
+# name -> (synthesize(text, lang, slow) -> bytes, file extension)
+TTS_BACKENDS: Dict[str, Tuple[Callable[[str, str, bool], bytes], str]] = {
+    "gtts": (_gtts_backend, "mp3"),
+    "espeak": (_espeak_backend, "wav"),
+    "silent": (_silent_backend, "wav"),
+}
+
+def register_tts_backend(name: str, fn: Callable[[str, str, bool], bytes], ext: str = "wav"):
+    TTS_BACKENDS[name] = (fn, ext)
+
+def tts_format(backend: Optional[str] = None) -> str:
+    """MIME type of the audio a backend produces, e.g. for st.audio(format=...)."""
+    ext = TTS_BACKENDS[backend or TTS_BACKEND][1]
+    return {"mp3": "audio/mp3", "wav": "audio/wav", "ogg": "audio/ogg"}.get(ext, f"audio/{ext}")
 
 # -----------------------
-# Text-to-Speech (gTTS)
+# Audio cache
 # -----------------------
+class TTSCache:
+    """
+    Content-addressed audio files (`<sha256>.<ext>` of backend, language,
+    voice settings and text) with LRU eviction by total size. Recency is the
+    file mtime, so the order survives restarts and is shared by processes
+    using the same directory.
+    """
+    def __init__(self, cache_dir: str = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MB * 1024 * 1024)):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+        self.files: "OrderedDict[str, int]" = OrderedDict((n, size) for _, n, size in sorted(entries))
+        self.total = sum(self.files.values())
+
+    @staticmethod
+    def key(text: str, lang: str, backend: str, **settings) -> str:
+        blob = json.dumps({"text": text, "lang": lang, "backend": backend, **settings},
+                          ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, name: str) -> Optional[bytes]:
+        path = os.path.join(self.dir, name)
+        with self.lock:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                self.files.pop(name, None)
+                self.misses += 1
+                return None
+            os.utime(path)  # mark recently used
+            self.files[name] = len(data)
+            self.files.move_to_end(name)
+            self.hits += 1
+            return data
+
+    def put(self, name: str, data: bytes):
+        path = os.path.join(self.dir, name)
+        with self.lock:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.total += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            while self.total > self.max_bytes and len(self.files) > 1:
+                old, size = self.files.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(os.path.join(self.dir, old))
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "files": len(self.files),
+                "bytes": self.total, "max_bytes": self.max_bytes}
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+def get_tts_cache() -> Optional[TTSCache]:
+    global _tts_cache
+    if TTS_CACHE_MB <= 0:
+        return None
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = TTSCache()
+    return _tts_cache
+
+def synthesize(text: str, lang_hint: str = "en", backend: Optional[str] = None, slow: bool = False) -> bytes:
+    """Audio bytes for `text` (format: tts_format(backend)), served from the cache when possible."""
+    backend = backend or TTS_BACKEND
+    fn, ext = TTS_BACKENDS[backend]
+    lang = _tts_lang(lang_hint)
+    cache = get_tts_cache()
+    if cache is None:
+        return fn(text, lang, slow)
+    name = f"{TTSCache.key(text, lang, backend, slow=slow)}.{ext}"
+    data = cache.get(name)
+    if data is None:
+        data = fn(text, lang, slow)
+        cache.put(name, data)
+    return data
+
 def tts_gtts(text: str, lang_hint: str = "en") -> bytes:
     """
-    Return an MP3 byte stream for the given text.
+    Return an MP3 byte stream for the given text (via the audio cache).
     lang_hint: 'en' | 'hi' | 'pa'
     """
-    lang_map = {"en": "en", "hi": "hi", "pa": "pa"}
-    lang = lang_map.get((lang_hint or "en").lower(), "en")
+    return synthesize(text, lang_hint, backend="gtts")
 
-    mp3_buf = io.BytesIO()
-    tts = gTTS(text=text, lang=lang, slow=False)
-    tts.write_to_fp(mp3_buf)
-    return mp3_buf.getvalue()
+# -----------------------
+# Sentence pipeline
+# -----------------------
+_SENTENCE_END = re.compile(r"(?<=[.!?।॥])\s+|\n+")
+
+def split_sentences(text: str, max_chars: int = 250, min_chars: int = 40) -> List[str]:
+    """
+    Sentence-sized TTS segments: split after . ! ? । ॥ and newlines, glue
+    fragments shorter than `min_chars` to the next one, and cut sentences
+    longer than `max_chars` at the last comma or space before the limit.
+    """
+    out, buf = [], ""
+    for part in _SENTENCE_END.split(text or ""):
+        part = part.strip()
+        if not part:
+            continue
+        buf = f"{buf} {part}" if buf else part
+        if len(buf) < min_chars:
+            continue
+        while len(buf) > max_chars:
+            cut = max(buf.rfind(", ", 0, max_chars) + 1, buf.rfind(" ", 0, max_chars))
+            cut = cut if cut > 0 else max_chars
+            out.append(buf[:cut].strip())
+            buf = buf[cut:].strip()
+        out.append(buf)
+        buf = ""
+    if buf:
+        if out and len(out[-1]) + len(buf) < max_chars:
+            out[-1] = f"{out[-1]} {buf}"
+        else:
+            out.append(buf)
+    return out
+
+def synthesize_segments(text: str, lang_hint: str = "en", backend: Optional[str] = None,
+                        workers: int = TTS_WORKERS) -> Iterator[bytes]:
+    """
+    Yield audio per sentence, in order. All sentences are synthesized
+    concurrently (and cached individually), so the first segment is ready
+    after one sentence's latency instead of the whole answer's.
+    """
+    segments = split_sentences(text)
+    if not segments:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(segments))), thread_name_prefix="tts") as pool:
+        futures = [pool.submit(synthesize, seg, lang_hint, backend) for seg in segments]
+        try:
+            for fut in futures:
+                yield fut.result()
+        finally:
+            for fut in futures:
+                fut.cancel()  # consumer stopped early
+
+def join_audio(segments: List[bytes], fmt: str) -> bytes:
+    """Concatenate segments of one backend: MP3 frames join as-is, WAV is re-wrapped."""
+    if fmt != "audio/wav":
+        return b"".join(segments)
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        for i, seg in enumerate(segments):
+            with wave.open(io.BytesIO(seg), "rb") as r:
+                if i == 0:
+                    w.setparams(r.getparams())
+                w.writeframes(r.readframes(r.getnframes()))
+    return out.getvalue()
 
 # -----------------------
 # Speech-to-Text (Groq Whisper)
@@ -39,12 +254,89 @@ def _whisper_lang(lang_hint: str) -> Optional[str]:
     # default to auto if unknown
     return None
 
-def transcribe_audio_bytes(audio_bytes: bytes, lang_hint: str = "auto") -> Optional[str]:
+# upload preprocessing for WAV input (STT_PREPROCESS=0 sends the recording untouched)
+STT_PREPROCESS = os.environ.get("STT_PREPROCESS", "1") != "0"
+STT_SAMPLE_RATE = 16000  # Whisper resamples to 16 kHz mono anyway
+STT_SILENCE = 0.01  # RMS (fraction of full scale) below which leading/trailing audio is trimmed
+
+@lru_cache(maxsize=4)
+def _groq_client(api_key: str, base_url: Optional[str]):
+    # one client (and HTTP connection pool) per key/endpoint instead of per call
+    from groq import Groq
+    return Groq(api_key=api_key, **({"base_url": base_url} if base_url else {}))
+
+def _lowpass(x, cutoff: float, taps: int = 101):
+    """Windowed-sinc FIR low-pass; `cutoff` is a fraction of the Nyquist frequency."""
+    import numpy as np
+    n = np.arange(taps) - (taps - 1) / 2
+    h = cutoff * np.sinc(cutoff * n) * np.hamming(taps)
+    return np.convolve(x, h / h.sum(), mode="same").astype("float32")
+
+def preprocess_audio(audio_bytes: bytes, trim: bool = True, rate: int = STT_SAMPLE_RATE,
+                     compress: bool = True):
+    """
+    Shrink a PCM WAV recording for upload: downmix to mono, resample to `rate`,
+    trim leading/trailing silence and, if `soundfile` is installed, encode as
+    FLAC (else 16-bit WAV). Returns (bytes, filename); non-WAV input is
+    returned unchanged as "audio.webm".
+    """
+    import numpy as np
+    try:
+        with wave.open(io.BytesIO(audio_bytes), "rb") as r:
+            channels, width, src_rate = r.getnchannels(), r.getsampwidth(), r.getframerate()
+            raw = r.readframes(r.getnframes())
+    except (wave.Error, EOFError):
+        return audio_bytes, "audio.webm"
+    if width == 1:
+        x = (np.frombuffer(raw, dtype=np.uint8).astype("float32") - 128) / 128
+    elif width == 2:
+        x = np.frombuffer(raw, dtype="<i2").astype("float32") / 32768
+    elif width == 4:
+        x = np.frombuffer(raw, dtype="<i4").astype("float32") / 2147483648
+    else:
+        return audio_bytes, "audio.wav"
+    x = x.reshape(-1, channels).mean(axis=1)
+    if src_rate != rate and len(x):
+        if rate < src_rate:
+            x = _lowpass(x, 0.9 * rate / src_rate)  # drop content above the new Nyquist before decimating
+        n = int(round(len(x) * rate / src_rate))
+        x = np.interp(np.arange(n) * (src_rate / rate), np.arange(len(x)), x).astype("float32")
+    if trim and len(x):
+        win = rate // 50  # 20 ms
+        frames = len(x) // win
+        if frames:
+            rms = np.sqrt((x[:frames * win].reshape(frames, win) ** 2).mean(axis=1))
+            voiced = np.flatnonzero(rms >= STT_SILENCE)
+            if len(voiced):
+                pad = 10  # keep 200 ms around speech
+                x = x[max(0, voiced[0] - pad) * win:min(frames, voiced[-1] + 1 + pad) * win]
+    pcm = (np.clip(x, -1, 1) * 32767).astype("<i2")
+    if compress:
+        try:
+            import soundfile as sf
+            buf = io.BytesIO()
+            sf.write(buf, pcm, rate, format="FLAC")
+            return buf.getvalue(), "audio.flac"
+        except (ImportError, OSError):  # OSError: soundfile without the libsndfile library
+            pass
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+    return buf.getvalue(), "audio.wav"
+
+def transcribe_audio_bytes(audio_bytes: bytes, lang_hint: str = "auto", preprocess: Optional[bool] = None,
+                           timings: Optional[Dict[str, float]] = None) -> Optional[str]:
     """
     Transcribe raw audio bytes using Groq Whisper API.
     Requires:
       pip install groq
-      env var GROQ_API_KEY set
+      env var GROQ_API_KEY set (GROQ_BASE_URL overrides the endpoint, e.g. tests/stub_server.py)
+    The recording is uploaded from memory, optionally shrunk by
+    preprocess_audio. `timings` (a dict) receives per-stage seconds
+    ("preprocess", "request") and the byte sizes before/after.
     Returns stripped text or None on failure.
     """
     if not audio_bytes:
@@ -54,30 +346,33 @@ def transcribe_audio_bytes(audio_bytes: bytes, lang_hint: str = "auto") -> Optio
     if not api_key:
         # No key → gracefully return None (UI just won't prefill)
         return None
+    timings = timings if timings is not None else {}
 
     try:
-        from groq import Groq
-        client = Groq(api_key=api_key)
-
-        # Write bytes to a temporary WAV file for upload
-        # (streamlit-mic-recorder usually yields WAV bytes)
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as tmp:
-            tmp.write(audio_bytes)
-            tmp.flush()
-
-            language = _whisper_lang(lang_hint)  # None => auto-detect
-            # Groq Whisper models: "whisper-large-v3" (multilingual), "distil-whisper-large-v3-en" (English)
-            model_name = "whisper-large-v3" if language is None or language != "en" else "distil-whisper-large-v3-en"
-
-            with open(tmp.name, "rb") as f:
-                resp = client.audio.transcriptions.create(
-                    file=f,
-                    model=model_name,
-                    # language can be omitted for auto; pass only if specified
-                    **({"language": language} if language else {}),
-                    # You can request plain text
-                    response_format="text"
-                )
+        client = _groq_client(api_key, os.environ.get("GROQ_BASE_URL") or None)
+
+        # streamlit-mic-recorder usually yields WAV bytes
+        t0 = time.perf_counter()
+        if STT_PREPROCESS if preprocess is None else preprocess:
+            data, filename = preprocess_audio(audio_bytes)
+        else:
+            data, filename = audio_bytes, "audio.wav"
+        timings.update(preprocess=time.perf_counter() - t0, bytes_in=len(audio_bytes), bytes_out=len(data))
+
+        language = _whisper_lang(lang_hint)  # None => auto-detect
+        # Groq Whisper models: "whisper-large-v3" (multilingual), "distil-whisper-large-v3-en" (English)
+        model_name = "whisper-large-v3" if language is None or language != "en" else "distil-whisper-large-v3-en"
+
+        t0 = time.perf_counter()
+        resp = client.audio.transcriptions.create(
+            file=(filename, data),  # in-memory upload, no temp file
+            model=model_name,
+            # language can be omitted for auto; pass only if specified
+            **({"language": language} if language else {}),
+            # You can request plain text
+            response_format="text"
+        )
+        timings["request"] = time.perf_counter() - t0
 
         # `resp` is a string when response_format="text"
         text = (resp or "").strip()
@@ -0,0 +1,19 @@
+# tests/conftest.py
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_server import start_stub_server  # noqa: E402
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Stub Groq endpoint for chat completions and Whisper; yields the server (see server.cfg)."""
+    server, base = start_stub_server(token_delay=0, first_token_delay=0, transcribe_delay=0)
+    monkeypatch.setenv("LLM_API_URL", base + "/openai/v1/chat/completions")
+    monkeypatch.setenv("GROQ_BASE_URL", base)
+    monkeypatch.setenv("GROQ_API_KEY", "stub")
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,108 @@
+# tests/stub_server.py
+# Local OpenAI-compatible stand-in for the Groq API, so streaming and latency
+# can be exercised offline (the `stub` fixture in conftest.py wires it up):
+#
+#     server, base = start_stub_server(reply="Namaste! ...", token_delay=0.02)
+#     os.environ["LLM_API_URL"] = base + "/openai/v1/chat/completions"
+#     os.environ.setdefault("GROQ_API_KEY", "stub")
+#     print(measure_ttft(chat_complete_stream))
+#     server.shutdown()
+#
+# It also answers Whisper uploads (POST .../audio/transcriptions) with
+# `transcript`; point the Groq client at it with GROQ_BASE_URL=base.
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "Register on pgrkam.com, verify your mobile OTP, then complete your profile. (https://www.pgrkam.com)"
+DEFAULT_TRANSCRIPT = "How do I register on PGRKAM?"
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status: int, obj: dict):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _transcribe(self, body: bytes):
+        cfg = self.server.cfg
+        cfg["uploads"].append(len(body))  # multipart size, for upload-size checks
+        time.sleep(cfg["transcribe_delay"])
+        text = cfg["transcript"]
+        if b'name="response_format"\r\n\r\ntext' in body:
+            data = text.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(200, {"text": text})
+
+    def do_POST(self):
+        cfg = self.server.cfg
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if self.path.endswith("/audio/transcriptions"):
+            return self._transcribe(body)
+        req = json.loads(body or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+        time.sleep(cfg["first_token_delay"])
+        reply = cfg["reply"]
+        model = req.get("model", "stub")
+
+        if not req.get("stream"):
+            return self._send_json(200, {
+                "id": "stub", "object": "chat.completion", "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        # word-level "tokens", keeping the separating whitespace
+        tokens = [w + " " for w in reply.split(" ")]
+        tokens[-1] = tokens[-1][:-1]
+        for tok in tokens:
+            event = {"id": "stub", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": tok}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(cfg["token_delay"])
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+def start_stub_server(reply: str = DEFAULT_REPLY, token_delay: float = 0.02,
+                      first_token_delay: float = 0.1, host: str = "127.0.0.1", port: int = 0,
+                      transcript: str = DEFAULT_TRANSCRIPT, transcribe_delay: float = 0.05):
+    """
+    Serve in a daemon thread; returns (server, base_url). Stop with server.shutdown().
+    server.cfg["uploads"] lists the byte size of each transcription request.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.cfg = {"reply": reply, "token_delay": token_delay, "first_token_delay": first_token_delay,
+                  "transcript": transcript, "transcribe_delay": transcribe_delay, "uploads": []}
+    threading.Thread(target=server.serve_forever, name="llm-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def measure_ttft(stream_fn, system_prompt: str = "stub", user_prompt: str = "ping") -> dict:
+    """Time to first token and total time (seconds) for a streaming chat function."""
+    t0 = time.perf_counter()
+    ttft, parts = None, []
+    for tok in stream_fn(system_prompt, user_prompt):
+        if ttft is None:
+            ttft = time.perf_counter() - t0
+        parts.append(tok)
+    return {"ttft": ttft, "total": time.perf_counter() - t0, "tokens": len(parts), "text": "".join(parts)}
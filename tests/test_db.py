@@ -0,0 +1,44 @@
+# tests/test_db.py
+import json
+import pytest
+from sqlalchemy import create_engine
+from services import db
+
+# (query, table, index init_db must serve it from)
+HOT_QUERIES = [
+    ("SELECT intent, COUNT(*) FROM messages WHERE intent != '' GROUP BY intent",
+     "messages", "ix_messages_intent"),
+    ("SELECT (ts / 3600) * 3600, COUNT(*) FROM messages WHERE ts >= :since GROUP BY 1",
+     "messages", "ix_messages_ts"),
+    ("SELECT role, content, ts FROM messages WHERE user_key = :uk ORDER BY ts DESC LIMIT 20",
+     "messages", "ix_messages_user_ts"),
+    ("SELECT value, ts FROM events WHERE user_key = :uk AND name = :name AND ts >= :since",
+     "events", "ix_events_user_name_ts"),
+    ("SELECT id, user_key FROM users WHERE email = :em",
+     "users", "ux_users_email"),
+]
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "engine", create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True))
+    db.init_db()
+    yield db.engine
+    db.engine.dispose()
+
+@pytest.mark.parametrize("sql,table,index", HOT_QUERIES)
+def test_hot_queries_use_indexes(temp_db, sql, table, index):
+    plan = db.explain(sql, {"since": 0, "uk": "u", "name": "ask", "em": "a@b.c"})
+    assert any(f"INDEX {index}" in step for step in plan), plan
+    assert f"SCAN {table}" not in plan, plan  # full table scan without an index
+
+def test_migrate_accounts_json_skips_malformed_entries(temp_db, tmp_path):
+    path = tmp_path / "users.json"
+    path.write_text(json.dumps({
+        "ok@example.com": {"user_id": "user-1", "name": "Ok", "pass_hash": "h1", "created_at": 1},
+        "nohash@example.com": {"user_id": "user-2", "name": "No hash"},
+        "notadict@example.com": "user-3",
+    }), encoding="utf-8")
+    assert db.migrate_accounts_json(str(path)) == 1
+    assert db.get_user_by_email("ok@example.com")["user_key"] == "user-1"
+    assert db.get_user_by_email("nohash@example.com") is None
+    assert not path.exists() and (tmp_path / "users.json.migrated").exists()
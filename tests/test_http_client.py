@@ -0,0 +1,34 @@
+# tests/test_http_client.py
+import socket
+import httpx
+import pytest
+from services import http_client
+from stub_server import start_stub_server
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_client, "backoff_delay", lambda attempt, retry_after=None: 0)
+    http_client.reset_stats()
+
+def _stats(method: str, url: str) -> dict:
+    return http_client.latency_stats()[http_client._endpoint(method, url)]
+
+def test_post_read_timeout_is_not_retried():
+    server, base = start_stub_server(first_token_delay=0.5)
+    url = base + "/openai/v1/chat/completions"
+    try:
+        with pytest.raises(httpx.ReadTimeout):
+            http_client.request("POST", url, json={"messages": []}, timeout=0.1)
+        assert _stats("POST", url)["retries"] == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_post_connect_error_is_retried():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # closed once the with-block exits
+    url = f"http://127.0.0.1:{port}/openai/v1/chat/completions"
+    with pytest.raises(httpx.ConnectError):
+        http_client.request("POST", url, retries=2, json={})
+    assert _stats("POST", url)["retries"] == 2
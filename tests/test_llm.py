@@ -0,0 +1,36 @@
+# tests/test_llm.py
+import io
+import wave
+import pytest
+from services.llm import chat_complete, chat_complete_stream
+from services.voice import transcribe_audio_bytes
+from stub_server import DEFAULT_REPLY, DEFAULT_TRANSCRIPT, measure_ttft
+
+def test_chat_complete(stub):
+    assert chat_complete("system", "How do I register?") == DEFAULT_REPLY
+
+def test_chat_complete_stream_yields_tokens(stub):
+    result = measure_ttft(chat_complete_stream)
+    assert result["text"] == DEFAULT_REPLY
+    assert result["tokens"] == len(DEFAULT_REPLY.split(" "))
+    assert result["ttft"] <= result["total"]
+
+def test_chat_complete_stream_reports_api_errors(stub, monkeypatch):
+    monkeypatch.setenv("LLM_API_URL", f"http://127.0.0.1:{stub.server_address[1]}/openai/v1/unknown")
+    with pytest.raises(RuntimeError, match="404"):
+        list(chat_complete_stream("system", "ping"))
+
+def _wav(seconds: float = 0.5, rate: int = 16000) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\x00\x00" * int(seconds * rate))
+    return buf.getvalue()
+
+def test_transcribe_audio_bytes(stub):
+    timings = {}
+    text = transcribe_audio_bytes(_wav(), lang_hint="en", preprocess=False, timings=timings)
+    assert text == DEFAULT_TRANSCRIPT
+    assert stub.cfg["uploads"] and timings["bytes_out"] == timings["bytes_in"]
@@ -0,0 +1,32 @@
+# tests/test_voice.py
+import io
+import wave
+import numpy as np
+from services.voice import preprocess_audio
+
+def _tone_wav(freq: float, rate: int = 48000, seconds: float = 1.0) -> bytes:
+    t = np.arange(int(rate * seconds)) / rate
+    pcm = (0.5 * np.sin(2 * np.pi * freq * t) * 32767).astype("<i2")
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+def _rms(wav: bytes) -> float:
+    with wave.open(io.BytesIO(wav), "rb") as r:
+        assert r.getframerate() == 16000
+        x = np.frombuffer(r.readframes(r.getnframes()), dtype="<i2").astype("float32") / 32768
+    return float(np.sqrt(np.mean(x[200:-200] ** 2)))  # skip the filter's edge transients
+
+def test_downsampling_keeps_speech_band():
+    data, name = preprocess_audio(_tone_wav(1000), trim=False, rate=16000, compress=False)
+    assert name == "audio.wav"
+    assert _rms(data) > 0.3  # 0.5 amplitude sine → rms ≈ 0.35
+
+def test_downsampling_does_not_alias():
+    # 10 kHz is above the 8 kHz Nyquist of 16 kHz audio; without a low-pass it folds to 6 kHz
+    data, _ = preprocess_audio(_tone_wav(10000), trim=False, rate=16000, compress=False)
+    assert _rms(data) < 0.02